@@ -1,24 +1,1380 @@
 import getpass
-import requests
 import re
 import sys
 import json
 import os
-from datetime import datetime
+from datetime import datetime, timezone
 import time
 import argparse
 from enum import Enum
 import signal
-from tqdm import tqdm
+import threading
+import queue
+import itertools
+import urllib.parse
+import contextlib
+import copy
+import collections
+import email.utils
+import sqlite3
+import concurrent.futures
+import shutil
+import hashlib
+import mmap
+import csv
+import stat
+
+# Heavy dependencies, imported by load_dependencies() on first use : importing the module is fast and has no side effect
+requests = None
+tqdm = None
+
+
+# Import the heavy dependencies (requests, tqdm)
+def load_dependencies():
+    global requests, tqdm
+
+    if tqdm is None:
+        import requests
+        import requests.adapters
+        from tqdm import tqdm
+
+
+# Error stopping an action (site not available, login refused...), exit_code : exit code of the command
+class CKError(Exception):
+    def __init__(self, message, exit_code=1):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+# Downloaded content not matching the hash of its /data path
+class CKHashMismatchError(Exception):
+    pass
+
+
+# Error of a data node (see CKDataNodes) : the file is requested from another node
+class CKDataNodeError(Exception):
+    pass
+
+
+# Pool of download workers fed by a priority queue
+class CKDownloadQueue:
+    # Constructor
+    # Arguments :
+    # - nb_workers : number of tasks executed in parallel
+    # - max_pending : max number of queued tasks, put() waits for a free place (no limit if omitted)
+    def __init__(self, nb_workers, max_pending=None):
+        self.__queue = queue.PriorityQueue()
+        self.__counter = itertools.count()
+        self.__pending = threading.BoundedSemaphore(max_pending) if max_pending else None
+        self.__lock = threading.Lock()
+        self.__cancelled = False
+
+        self.__workers = [threading.Thread(target=self.__work, daemon=True) for i in range(nb_workers)]
+        for worker in self.__workers:
+            worker.start()
+
+    # Task result : the task is queued again, after the tasks already queued
+    REQUEUE = "requeue"
+
+    # Queue a task (callable without argument), lowest priority first then first in first out
+    # Raises CKError if the queue is cancelled (see close)
+    def put(self, task, priority=0):
+        if self.__pending:
+            self.__pending.acquire()
+
+        with self.__lock:
+            if self.__cancelled:
+                if self.__pending:
+                    self.__pending.release()
+                raise CKError("Downloads stopped")
+            self.__queue.put((priority, next(self.__counter), task))
+
+    # Wait for all the queued tasks
+    def join(self):
+        self.__queue.join()
+
+    # Stop the workers
+    # Arguments :
+    # - cancel : if false, wait for all the queued tasks, otherwise drop the queued tasks and do not wait for the tasks in progress (error, program stopped)
+    def close(self, cancel=False):
+        if cancel:
+            with self.__lock:
+                self.__cancelled = True
+                while True:
+                    try:
+                        self.__queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if self.__pending:
+                        self.__pending.release()
+                    self.__queue.task_done()
+        else:
+            self.join()
+
+        # One end marker (no task) per worker, the queue being empty
+        for worker in self.__workers:
+            self.__queue.put((0, next(self.__counter), None))
+
+        if not cancel:
+            for worker in self.__workers:
+                worker.join()
+
+    # Worker loop
+    def __work(self):
+        while True:
+            priority, counter, task = self.__queue.get()
+            if task is None:
+                self.__queue.task_done()
+                return
+
+            result = None
+            try:
+                result = task()
+            except Exception as e:
+                print("Download error : " + type(e).__name__ + " (" + str(e) + ")")
+            finally:
+                # A requeued task keeps its place in the pending tasks (dropped if the queue is cancelled)
+                with self.__lock:
+                    if result == CKDownloadQueue.REQUEUE and not self.__cancelled:
+                        self.__queue.put((priority, next(self.__counter), task))
+                    elif self.__pending:
+                        self.__pending.release()
+                self.__queue.task_done()
+
+
+# Aggregate progress of parallel downloads : one progress bar for all the transfers
+class CKProgress:
+    # Constructor
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__nb_files = 0
+        self.__nb_files_per_status = {}
+        load_dependencies()
+        self.__bar = tqdm(desc="Download", total=0, unit='B', unit_scale=True, unit_divisor=1024)
+
+    # File queued
+    def add_file(self):
+        with self.__lock:
+            self.__nb_files += 1
+
+    # Add a transfer of size bytes to the total, already_downloaded bytes being done
+    def add_size(self, size, already_downloaded=0):
+        with self.__lock:
+            self.__bar.total += size
+            self.__bar.update(already_downloaded)
+
+    # Bytes received
+    def update(self, size):
+        with self.__lock:
+            self.__bar.update(size)
+
+    # File processed, status : "downloaded", "skipped", "ignored" or "failed"
+    def file_done(self, status):
+        with self.__lock:
+            self.__nb_files_per_status[status] = self.__nb_files_per_status.get(status, 0) + 1
+            nb_files_done = sum(self.__nb_files_per_status.values())
+            self.__bar.set_postfix_str("files " + str(nb_files_done) + "/" + str(self.__nb_files))
+
+    # Display a message without breaking the progress bar
+    def write(self, message):
+        with self.__lock:
+            self.__bar.write(message)
+
+    # Close the progress bar and display the summary
+    def close(self):
+        self.__bar.close()
+        for status in self.__nb_files_per_status:
+            print("Nb " + status + " : " + str(self.__nb_files_per_status[status]))
+
+
+# Persistent cache shared by the runs (SQLite database)
+class CKCache:
+    # Constructor
+    # Arguments :
+    # - cache_dir : directory of the database (created if needed)
+    def __init__(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(os.path.join(cache_dir, "cache.db"), check_same_thread=False)
+
+        with self.__lock, self.__connection:
+            self.__connection.execute("PRAGMA journal_mode=WAL")
+            # Files are stored by content hash, so the size of a path never changes
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS file_size (path TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+            # Post index : posts are sorted from the latest by sync batch (latest first) then position in the batch
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS post (site TEXT NOT NULL, service TEXT NOT NULL, user_id TEXT NOT NULL, post_id TEXT NOT NULL, "
+                                      "batch INTEGER NOT NULL, position INTEGER NOT NULL, data TEXT NOT NULL, PRIMARY KEY (site, service, user_id, post_id))")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS post_order ON post (site, service, user_id, batch DESC, position)")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS post_sync (site TEXT NOT NULL, service TEXT NOT NULL, user_id TEXT NOT NULL, "
+                                      "synced_at REAL NOT NULL, complete INTEGER NOT NULL, batch INTEGER NOT NULL, PRIMARY KEY (site, service, user_id))")
+            # User names (download directories), for the runs on the local index
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS user_name (site TEXT NOT NULL, service TEXT NOT NULL, user_id TEXT NOT NULL, "
+                                      "name TEXT NOT NULL, PRIMARY KEY (site, service, user_id))")
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS user_exists (site TEXT NOT NULL, service TEXT NOT NULL, user_id TEXT NOT NULL, "
+                                      "user_exists INTEGER NOT NULL, checked_at REAL NOT NULL, PRIMARY KEY (site, service, user_id))")
+            # Pages of posts probed by the date seek : "added" date of the last post of the page at this offset
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS post_offset (site TEXT NOT NULL, service TEXT NOT NULL, user_id TEXT NOT NULL, "
+                                      "post_offset INTEGER NOT NULL, last_added TEXT NOT NULL, checked_at REAL NOT NULL, "
+                                      "PRIMARY KEY (site, service, user_id, post_offset))")
+            # Data nodes of the sites, found in the redirects of the /data URLs
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS data_node (site TEXT NOT NULL, node_url TEXT NOT NULL, seen_at REAL NOT NULL, "
+                                      "PRIMARY KEY (site, node_url))")
+
+    # Close the database
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    # Get the known sizes of the file paths
+    # Returns {path: size}
+    def get_file_sizes(self, paths):
+        paths = list(paths)
+        file_sizes = {}
+
+        with self.__lock:
+            # Stay below the SQLite max number of parameters
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                rows = self.__connection.execute("SELECT path, size FROM file_size WHERE path IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+                file_sizes.update(rows)
+
+        return file_sizes
+
+    # Store file sizes ({path: size})
+    def set_file_sizes(self, file_sizes):
+        with self.__lock, self.__connection:
+            self.__connection.executemany("INSERT OR REPLACE INTO file_size (path, size) VALUES (?, ?)", file_sizes.items())
+
+    # Get the last synchronization of user's posts
+    # Returns {"synced_at": timestamp, "complete": bool, "batch": int} or None if never synchronized
+    def get_post_sync(self, site, service, user_id):
+        with self.__lock:
+            row = self.__connection.execute("SELECT synced_at, complete, batch FROM post_sync WHERE site = ? AND service = ? AND user_id = ?",
+                                            (site, service, user_id)).fetchone()
+
+        if row is None:
+            return None
+
+        return {"synced_at": row[0], "complete": bool(row[1]), "batch": row[2]}
+
+    # Store user's posts (in one transaction) and the synchronization state
+    # Arguments :
+    # - posts : posts from the latest, stored from position first_position in the batch
+    # - complete : all the user's posts are in the index
+    def add_posts(self, site, service, user_id, posts, batch, first_position=0, complete=False):
+        with self.__lock, self.__connection:
+            self.__connection.executemany("INSERT OR REPLACE INTO post (site, service, user_id, post_id, batch, position, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                          [(site, service, user_id, post["id"], batch, first_position + i, json.dumps(post)) for i, post in enumerate(posts)])
+            self.__connection.execute("INSERT OR REPLACE INTO post_sync (site, service, user_id, synced_at, complete, batch) VALUES (?, ?, ?, ?, ?, ?)",
+                                      (site, service, user_id, time.time(), int(complete), batch))
+
+    # Get the post IDs already in the index
+    def get_known_post_ids(self, site, service, user_id, post_ids):
+        post_ids = list(post_ids)
+
+        with self.__lock:
+            rows = self.__connection.execute("SELECT post_id FROM post WHERE site = ? AND service = ? AND user_id = ? AND post_id IN (" + ",".join("?" * len(post_ids)) + ")",
+                                             [site, service, user_id] + post_ids)
+            return set(row[0] for row in rows)
+
+    # Get user's name
+    # Returns name or None if unknown
+    def get_user_name(self, site, service, user_id):
+        with self.__lock:
+            row = self.__connection.execute("SELECT name FROM user_name WHERE site = ? AND service = ? AND user_id = ?", (site, service, user_id)).fetchone()
+
+        return row[0] if row else None
+
+    # Store user's name
+    def set_user_name(self, site, service, user_id, name):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO user_name (site, service, user_id, name) VALUES (?, ?, ?, ?)", (site, service, user_id, name))
+
+    # Get the users checked after min_checked_at
+    # Returns {user_id: bool}
+    def get_users_exist(self, site, service, user_ids, min_checked_at):
+        user_ids = list(user_ids)
+        users_exist = {}
+
+        with self.__lock:
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i:i + 500]
+                rows = self.__connection.execute("SELECT user_id, user_exists FROM user_exists WHERE site = ? AND service = ? AND checked_at >= ? "
+                                                 "AND user_id IN (" + ",".join("?" * len(chunk)) + ")", [site, service, min_checked_at] + chunk)
+                users_exist.update((row[0], bool(row[1])) for row in rows)
+
+        return users_exist
+
+    # Store user checks ({user_id: bool})
+    def set_users_exist(self, site, service, users_exist):
+        with self.__lock, self.__connection:
+            self.__connection.executemany("INSERT OR REPLACE INTO user_exists (site, service, user_id, user_exists, checked_at) VALUES (?, ?, ?, ?, ?)",
+                                          [(site, service, user_id, int(user_exists), time.time()) for user_id, user_exists in users_exist.items()])
+
+    # Get the largest offset of a page of posts all added after a date (new posts only move the page further)
+    # Returns offset or None if unknown
+    def get_newer_post_offset(self, site, service, user_id, date):
+        with self.__lock:
+            row = self.__connection.execute("SELECT MAX(post_offset) FROM post_offset WHERE site = ? AND service = ? AND user_id = ? AND last_added > ?",
+                                            (site, service, user_id, date.isoformat())).fetchone()
+
+        return row[0]
+
+    # Store a probed page of posts
+    # Arguments :
+    # - post_offset : offset of the page
+    # - last_added : "added" date of the last post of the page
+    def set_post_offset(self, site, service, user_id, post_offset, last_added):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO post_offset (site, service, user_id, post_offset, last_added, checked_at) VALUES (?, ?, ?, ?, ?, ?)",
+                                      (site, service, user_id, post_offset, last_added, time.time()))
+
+    # Get the data nodes of a site seen after min_seen_at
+    # Returns list of node URLs
+    def get_data_nodes(self, site, min_seen_at):
+        with self.__lock:
+            rows = self.__connection.execute("SELECT node_url FROM data_node WHERE site = ? AND seen_at >= ? ORDER BY node_url", (site, min_seen_at)).fetchall()
+
+        return [row[0] for row in rows]
+
+    # Store a data node seen in a redirect
+    def add_data_node(self, site, node_url):
+        with self.__lock, self.__connection:
+            self.__connection.execute("INSERT OR REPLACE INTO data_node (site, node_url, seen_at) VALUES (?, ?, ?)", (site, node_url, time.time()))
+
+    # Get user's posts from the index, from the latest
+    def get_posts(self, site, service, user_id, offset, limit):
+        with self.__lock:
+            rows = self.__connection.execute("SELECT data FROM post WHERE site = ? AND service = ? AND user_id = ? ORDER BY batch DESC, position LIMIT ? OFFSET ?",
+                                             (site, service, user_id, limit, offset)).fetchall()
+
+        return [json.loads(row[0]) for row in rows]
+
+
+# Download statistics of a user
+class CKDownloadStats:
+    # Constructor
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__start_time = time.monotonic()
+        self.__end_time = None
+        self.listing_completed = False
+        self.nb_files = 0
+        self.nb_bytes = 0
+        self.nb_files_per_type = {}
+        self.nb_files_per_status = {}
+        self.nb_linked_bytes = 0
+
+    # File queued
+    def file_queued(self, file_type):
+        with self.__lock:
+            self.nb_files += 1
+            self.nb_files_per_type[str(file_type)] = self.nb_files_per_type.get(str(file_type), 0) + 1
+
+    # File processed, status : "downloaded", "linked", "skipped", "ignored" or "failed"
+    def file_done(self, status):
+        with self.__lock:
+            self.nb_files_per_status[status] = self.nb_files_per_status.get(status, 0) + 1
+            self.__end_time = time.monotonic()
+
+    # Bytes received
+    def add_bytes(self, size):
+        with self.__lock:
+            self.nb_bytes += size
+
+    # File linked from the content-addressed store instead of being downloaded
+    def file_linked(self, size):
+        with self.__lock:
+            self.nb_linked_bytes += size
+
+    # End of the listing, completed : all the user's files are queued
+    def listing_done(self, completed=True):
+        with self.__lock:
+            self.listing_completed = completed
+            self.__end_time = max(self.__end_time or 0, time.monotonic())
+
+    # Time between the start of the listing and the last file processed, in seconds
+    def get_wall_time(self):
+        with self.__lock:
+            return (self.__end_time or time.monotonic()) - self.__start_time
+
+
+# Download journal of a target directory : one JSON object per line, appended as the run goes
+# - {"run": "start", "filters": {...}} : start of a run with its filters, {"run": "end"} : run completed
+# - {"listing": "completed"} : all the files of the run are recorded (the listing is recorded before the downloads start)
+# - {"name": "file name", "state": "queued", "file": {...}} : file queued (see CKUtils.__get_user_files)
+# - {"name": "file name", "state": "in-progress", "bytes": n} : download started or interrupted with n bytes written
+# - {"name": "file name", "state": "completed"|"failed"} : download done
+#
+# The journal is compacted when it is opened : one line per file, completed files without their details.
+class CKJournal:
+    FILE_NAME = ".ckutils-journal"
+
+    # Journals open in the process, flushed on Ctrl-C (reentrant : Ctrl-C may come while the main thread holds the lock)
+    open_journals = set()
+    open_journals_lock = threading.RLock()
+
+    # Constructor
+    # Arguments :
+    # - directory : target directory of the downloads (created if needed)
+    # - filters : filters of the run, the unfinished files of an interrupted run are resumed only with the same filters
+    def __init__(self, directory, filters):
+        os.makedirs(directory, exist_ok=True)
+        self.__file_name = os.path.join(directory, CKJournal.FILE_NAME)
+        # Reentrant : Ctrl-C may flush the journal while the main thread writes in it
+        self.__lock = threading.RLock()
+        # {file name: {"state": "string", "file": {...} or CKFile (queued by this run)}}
+        self.__entries = {}
+        # {file name: .tmp file name}
+        self.__in_progress = {}
+        self.__closed = False
+
+        run_filters = None
+        run_ended = True
+        listing_completed = False
+        # Files queued by the last run
+        run_names = set()
+
+        if os.path.isfile(self.__file_name):
+            with open(self.__file_name) as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Line truncated by a crash
+                        continue
+
+                    if "run" in record:
+                        run_ended = record["run"] == "end"
+                        if record["run"] == "start":
+                            run_filters = record.get("filters")
+                            listing_completed = False
+                            run_names = set()
+                    elif "listing" in record:
+                        listing_completed = True
+                    elif "name" in record:
+                        entry = self.__entries.setdefault(record["name"], {})
+                        entry["state"] = record["state"]
+                        if "file" in record:
+                            entry["file"] = record["file"]
+                            if record["state"] == "queued":
+                                run_names.add(record["name"])
+
+        # Interrupted run with all its files queued : only its unfinished files are downloaded again, without listing the posts
+        self.resume_only = not run_ended and listing_completed and run_filters == filters
+        # Files of the interrupted run (the unfinished files of older runs may not match its filters)
+        self.__resumed_names = run_names if self.resume_only else set()
+
+        # Compaction, then the new run
+        with open(self.__file_name + ".new", "w") as journal_file:
+            for name, entry in self.__entries.items():
+                journal_file.write(json.dumps(CKJournal.__get_record(name, entry)) + "\n")
+            journal_file.write(json.dumps({"run": "start", "filters": filters}) + "\n")
+            if self.resume_only:
+                journal_file.write(json.dumps({"listing": "completed"}) + "\n")
+        os.replace(self.__file_name + ".new", self.__file_name)
+
+        # Line buffered : every record is written at once
+        self.__journal_file = open(self.__file_name, "a", buffering=1)
+
+        with CKJournal.open_journals_lock:
+            CKJournal.open_journals.add(self)
+
+    @staticmethod
+    def __get_record(name, entry):
+        record = {"name": name, "state": entry["state"]}
+        if entry["state"] != "completed" and "file" in entry:
+            record["file"] = entry["file"].to_dict() if isinstance(entry["file"], CKFile) else entry["file"]
+        return record
+
+    def __write(self, record):
+        with self.__lock:
+            if not self.__closed:
+                self.__journal_file.write(json.dumps(record) + "\n")
+
+    # Is the file completed by a previous run
+    def is_completed(self, name):
+        with self.__lock:
+            return self.__entries.get(name, {}).get("state") == "completed"
+
+    # Get the files not completed by the interrupted run resumed (see resume_only and CKUtils.__get_user_files)
+    def get_unfinished_files(self):
+        with self.__lock:
+            return [entry["file"] for name, entry in self.__entries.items()
+                    if name in self.__resumed_names and entry["state"] != "completed" and "file" in entry]
+
+    # File queued, file : CKFile (kept as is, written as a dictionary)
+    def file_queued(self, name, file):
+        with self.__lock:
+            self.__entries[name] = {"state": "queued", "file": file}
+            self.__write({"name": name, "state": "queued", "file": file.to_dict()})
+
+    # Download started or interrupted
+    # Arguments :
+    # - nb_bytes : bytes written in the .tmp file
+    # - tmp_file_name : .tmp file of the download (name + ".tmp" if omitted)
+    def file_in_progress(self, name, nb_bytes, tmp_file_name=None):
+        with self.__lock:
+            self.__entries.setdefault(name, {})["state"] = "in-progress"
+            self.__in_progress[name] = tmp_file_name or name + ".tmp"
+            self.__write({"name": name, "state": "in-progress", "bytes": nb_bytes})
+
+    # Download done, status : download status (see CKUtils.__download_file)
+    def file_done(self, name, status):
+        # Ignored files are checked again by the next runs (the .ignore file may be removed)
+        state = "completed" if status in ("downloaded", "skipped", "linked") else "failed" if status == "failed" else "queued"
+
+        with self.__lock:
+            # Skipped because completed by a previous run : nothing new
+            if state == "completed" and self.__entries.get(name, {}).get("state") == "completed":
+                return
+            entry = self.__entries.setdefault(name, {})
+            entry["state"] = state
+            # The details of a completed file are not needed anymore (not written by the compaction)
+            if state == "completed":
+                entry.pop("file", None)
+            self.__in_progress.pop(name, None)
+            self.__write({"name": name, "state": state})
+
+    # All the files of the run are queued
+    def listing_done(self):
+        self.__write({"listing": "completed"})
+
+    # Save the bytes written in the files being downloaded and write the journal to disk
+    def flush(self):
+        with self.__lock:
+            for name, tmp_file_name in self.__in_progress.items():
+                if os.path.isfile(tmp_file_name):
+                    self.__write({"name": name, "state": "in-progress", "bytes": os.path.getsize(tmp_file_name)})
+            if not self.__closed:
+                self.__journal_file.flush()
+                os.fsync(self.__journal_file.fileno())
+
+    # Close the journal
+    # Arguments :
+    # - completed : the run is completed (its unfinished files are not resumed alone by the next run)
+    def close(self, completed=True):
+        with CKJournal.open_journals_lock:
+            CKJournal.open_journals.discard(self)
+
+        with self.__lock:
+            if completed:
+                self.__write({"run": "end"})
+            self.flush()
+            self.__closed = True
+            self.__journal_file.close()
+
+    # Flush all the open journals (Ctrl-C)
+    @staticmethod
+    def flush_all():
+        with CKJournal.open_journals_lock:
+            journals = list(CKJournal.open_journals)
+
+        for journal in journals:
+            journal.flush()
+
+
+# Run metrics shared by all the threads : request latencies, bytes, file throughput, retries, file statuses and phase times.
+# Written at the end of the run as a JSON summary or as a Prometheus textfile (node_exporter textfile collector).
+class CKMetrics:
+    # Histogram bounds : request latency (time to the response headers) in seconds, file throughput in bytes per second
+    LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+    # Constructor
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__start_time = time.monotonic()
+        # {kind: histogram}, kind : "api", "login", "file_size", "file_head", "file_get", "file_range", "user_check"
+        self.__latencies = {}
+        # {(kind, status): number of requests}, status : HTTP status code or "error" (no response)
+        self.__requests = {}
+        # {kind: number of bytes received}
+        self.__bytes = {}
+        self.__throughput = CKMetrics.__new_histogram(CKMetrics.THROUGHPUT_BUCKETS)
+        # {kind: number of retries}, kind : "api", "user_check", "download" (error), "hash_mismatch" (corrupt download), "requeue" (throttled file)
+        self.__retries = {}
+        # {status: number of files}, status : "downloaded", "linked" (from the store), "skipped" (file exists), "ignored" (.ignore file) or "failed"
+        self.__files = {}
+        # {phase: [wall time in seconds, number of threads in the phase, start time]}
+        self.__phases = {}
+        self.__disk_write_time = 0
+        self.__nb_throttles = 0
+        self.__throttled_time = 0
+        self.__bandwidth_wait_time = 0
+
+    @staticmethod
+    def __new_histogram(buckets):
+        return {"buckets": buckets, "counts": [0] * (len(buckets) + 1), "sum": 0, "count": 0, "max": 0}
+
+    @staticmethod
+    def __observe(histogram, value):
+        index = 0
+        while index < len(histogram["buckets"]) and value > histogram["buckets"][index]:
+            index += 1
+        histogram["counts"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+        histogram["max"] = max(histogram["max"], value)
+
+    # Request done
+    # Arguments :
+    # - kind : request kind
+    # - status : HTTP status code, "error" if no response
+    # - latency : time to the response headers, in seconds
+    def request_done(self, kind, status, latency):
+        with self.__lock:
+            if kind not in self.__latencies:
+                self.__latencies[kind] = CKMetrics.__new_histogram(CKMetrics.LATENCY_BUCKETS)
+            CKMetrics.__observe(self.__latencies[kind], latency)
+            self.__requests[(kind, str(status))] = self.__requests.get((kind, str(status)), 0) + 1
+
+    # Bytes received by requests of a kind
+    def add_bytes(self, kind, size):
+        with self.__lock:
+            self.__bytes[kind] = self.__bytes.get(kind, 0) + size
+
+    # Request or download tried again
+    def retry(self, kind):
+        with self.__lock:
+            self.__retries[kind] = self.__retries.get(kind, 0) + 1
+
+    # File processed, status : "downloaded", "linked", "skipped", "ignored" or "failed"
+    def file_done(self, status):
+        with self.__lock:
+            self.__files[status] = self.__files.get(status, 0) + 1
+
+    # File downloaded
+    # Arguments :
+    # - size : bytes received for the file (without the bytes of a previous run)
+    # - transfer_time : time between the first request of the file and its completion, in seconds
+    def file_transferred(self, size, transfer_time):
+        if size <= 0:
+            return
+        with self.__lock:
+            CKMetrics.__observe(self.__throughput, size / max(transfer_time, 1e-6))
+
+    # Time spent writing the downloaded data, all threads together
+    def add_disk_write_time(self, seconds):
+        with self.__lock:
+            self.__disk_write_time += seconds
+
+    # Throttling of the site (see CKRateLimiter)
+    def set_throttling(self, nb_throttles, throttled_time):
+        with self.__lock:
+            self.__nb_throttles = nb_throttles
+            self.__throttled_time = throttled_time
+
+    # Time the transfers waited for the bandwidth cap, all threads together (see CKBandwidthLimiter)
+    def set_bandwidth_wait_time(self, seconds):
+        with self.__lock:
+            self.__bandwidth_wait_time = seconds
+
+    # Measure a phase : wall time during which at least one thread is in the phase
+    # ("posts" : pages of posts, "file_sizes" : size requests, "download" : file downloads, "user_checks" : collab checks)
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self.__lock:
+            phase = self.__phases.setdefault(name, [0, 0, 0])
+            if phase[1] == 0:
+                phase[2] = time.monotonic()
+            phase[1] += 1
+        try:
+            yield
+        finally:
+            with self.__lock:
+                phase[1] -= 1
+                if phase[1] == 0:
+                    phase[0] += time.monotonic() - phase[2]
+
+    # Get the metrics as a dictionary (JSON summary)
+    def to_dict(self):
+        with self.__lock:
+            now = time.monotonic()
+
+            def histogram_dict(histogram):
+                return {"count": histogram["count"], "sum": round(histogram["sum"], 6), "max": round(histogram["max"], 6),
+                        "mean": round(histogram["sum"] / histogram["count"], 6) if histogram["count"] else 0,
+                        "buckets": {str(bound): count for bound, count in zip(list(histogram["buckets"]) + ["+Inf"], histogram["counts"])}}
+
+            requests_per_kind = {}
+            for (kind, status), count in sorted(self.__requests.items()):
+                requests_per_kind.setdefault(kind, {})[status] = count
+
+            return {
+                "run_seconds": round(now - self.__start_time, 3),
+                "requests": {kind: {"statuses": requests_per_kind.get(kind, {}), "latency_seconds": histogram_dict(histogram)}
+                             for kind, histogram in sorted(self.__latencies.items())},
+                "bytes": dict(sorted(self.__bytes.items())),
+                "file_throughput_bytes_per_second": histogram_dict(self.__throughput),
+                "files": dict(sorted(self.__files.items())),
+                "retries": dict(sorted(self.__retries.items())),
+                "phases_seconds": {name: round(phase[0] + (now - phase[2] if phase[1] else 0), 3) for name, phase in sorted(self.__phases.items())},
+                "disk_write_seconds": round(self.__disk_write_time, 3),
+                "throttles": self.__nb_throttles,
+                "throttled_seconds": round(self.__throttled_time, 3),
+                "bandwidth_wait_seconds": round(self.__bandwidth_wait_time, 3)
+            }
+
+    # Get the metrics in the Prometheus text format
+    # Arguments :
+    # - labels : labels added to every metric ({"job": "coomer"}...)
+    def to_prometheus(self, labels=None):
+        metrics = self.to_dict()
+        lines = []
+
+        def label_string(**metric_labels):
+            all_labels = dict(labels or {}, **metric_labels)
+            if not all_labels:
+                return ""
+            return "{" + ",".join(key + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for key, value in all_labels.items()) + "}"
+
+        def add(name, metric_type, help_text, samples):
+            lines.append("# HELP ckutils_" + name + " " + help_text)
+            lines.append("# TYPE ckutils_" + name + " " + metric_type)
+            for suffix, sample_labels, value in samples:
+                lines.append("ckutils_" + name + suffix + label_string(**sample_labels) + " " + str(value))
+
+        def histogram_samples(histogram, **metric_labels):
+            samples = []
+            cumulated_count = 0
+            for bound, count in histogram["buckets"].items():
+                cumulated_count += count
+                samples.append(("_bucket", dict(metric_labels, le=bound), cumulated_count))
+            samples.append(("_sum", metric_labels, histogram["sum"]))
+            samples.append(("_count", metric_labels, histogram["count"]))
+            return samples
+
+        add("run_seconds", "gauge", "Duration of the run", [("", {}, metrics["run_seconds"])])
+        add("last_run_timestamp_seconds", "gauge", "End of the run (Unix time)", [("", {}, round(time.time(), 3))])
+        add("requests_total", "counter", "Requests per kind and HTTP status",
+            [("", {"kind": kind, "status": status}, count) for kind, request in metrics["requests"].items() for status, count in request["statuses"].items()])
+        add("request_duration_seconds", "histogram", "Request latency (time to the response headers) per kind",
+            [sample for kind, request in metrics["requests"].items() for sample in histogram_samples(request["latency_seconds"], kind=kind)])
+        add("received_bytes_total", "counter", "Bytes received per request kind", [("", {"kind": kind}, size) for kind, size in metrics["bytes"].items()])
+        add("file_throughput_bytes_per_second", "histogram", "Throughput of the downloaded files", histogram_samples(metrics["file_throughput_bytes_per_second"]))
+        add("files_total", "counter", "Files per download status", [("", {"status": status}, count) for status, count in metrics["files"].items()])
+        add("retries_total", "counter", "Retries per kind", [("", {"kind": kind}, count) for kind, count in metrics["retries"].items()])
+        add("phase_seconds", "gauge", "Wall time of each phase", [("", {"phase": name}, seconds) for name, seconds in metrics["phases_seconds"].items()])
+        add("disk_write_seconds_total", "counter", "Time spent writing downloaded data, all threads together", [("", {}, metrics["disk_write_seconds"])])
+        add("throttles_total", "counter", "Responses throttled by the site", [("", {}, metrics["throttles"])])
+        add("throttled_seconds_total", "counter", "Time spent waiting for the site to stop throttling", [("", {}, metrics["throttled_seconds"])])
+        add("bandwidth_wait_seconds_total", "counter", "Time the transfers waited for the bandwidth cap, all threads together",
+            [("", {}, metrics["bandwidth_wait_seconds"])])
+
+        return "\n".join(lines) + "\n"
+
+    # Write the JSON summary
+    def write_json(self, file_name):
+        CKMetrics.__write_file(file_name, json.dumps(self.to_dict(), indent=2) + "\n")
+
+    # Write the Prometheus textfile
+    def write_prometheus(self, file_name, labels=None):
+        CKMetrics.__write_file(file_name, self.to_prometheus(labels))
+
+    # Write a file atomically : a collector never reads a partial file
+    @staticmethod
+    def __write_file(file_name, content):
+        with open(file_name + ".new", "w") as metrics_file:
+            metrics_file.write(content)
+        os.replace(file_name + ".new", file_name)
+
+
+# Adaptive token bucket shared by all the threads :
+# - the rate is halved when the site throttles (HTTP 429/503, ddos-guard page) and all the requests wait for the end of a backoff pause
+#   (Retry-After if given by the site)
+# - then the rate increases slowly with the successful responses, up to 90 % of the rate that was throttled
+class CKRateLimiter:
+    MIN_RATE = 0.2
+
+    # Constructor
+    # Arguments :
+    # - max_rate : max number of requests per second (no limit until the site throttles if omitted)
+    def __init__(self, max_rate=None):
+        self.__lock = threading.Lock()
+        self.__max_rate = max_rate
+        self.__rate = max_rate
+        self.__rate_ceiling = max_rate
+        self.__tokens = max(max_rate or 1, 1)
+        self.__last_time = time.monotonic()
+        self.__pause_end_time = 0
+        self.__nb_throttles_in_row = 0
+        self.__request_times = collections.deque()
+        self.nb_throttles = 0
+        self.throttled_time = 0
+
+    # Is the response a throttling of the site
+    @staticmethod
+    def is_throttled(response):
+        return response.status_code in (429, 503) or response.headers.get('Server') == 'ddos-guard'
+
+    # Wait for the right to send a request
+    def acquire(self):
+        with self.__lock:
+            now = time.monotonic()
+            # No request before the end of the pause
+            send_time = max(now, self.__pause_end_time)
+
+            if self.__rate is not None:
+                self.__tokens = min(max(self.__rate, 1), self.__tokens + max(send_time - self.__last_time, 0) * self.__rate)
+                self.__last_time = send_time
+
+                # Reserve a token, waiting outside the lock for it to be refilled
+                self.__tokens -= 1
+                if self.__tokens < 0:
+                    send_time += -self.__tokens / self.__rate
+
+            # Requests of the last 10 seconds, to know the rate that was throttled
+            self.__request_times.append(send_time)
+            while self.__request_times[0] < send_time - 10:
+                self.__request_times.popleft()
+
+        if send_time > now:
+            time.sleep(send_time - now)
+
+    # Adapt the rate to a response
+    # Returns True if the site throttles the request
+    def response(self, response):
+        throttled = CKRateLimiter.is_throttled(response)
+
+        with self.__lock:
+            now = time.monotonic()
+
+            if not throttled:
+                self.__nb_throttles_in_row = 0
+                if self.__rate is not None:
+                    self.__rate = min(self.__rate + max(self.__rate * 0.01, 0.01), self.__rate_ceiling)
+                return False
+
+            self.nb_throttles += 1
+
+            # Requests in progress during a pause are throttled too : adapt only once
+            if now >= self.__pause_end_time:
+                self.__nb_throttles_in_row += 1
+
+                # Rate of the last requests (10 seconds at most)
+                throttled_rate = len(self.__request_times) / max(now - self.__request_times[0], 1) if self.__request_times else 0
+                if self.__rate is not None:
+                    throttled_rate = min(throttled_rate, self.__rate) if throttled_rate > 0 else self.__rate
+                self.__rate_ceiling = max(throttled_rate * 0.9, CKRateLimiter.MIN_RATE)
+                if self.__max_rate:
+                    self.__rate_ceiling = min(self.__rate_ceiling, self.__max_rate)
+                self.__rate = max(throttled_rate / 2, CKRateLimiter.MIN_RATE)
+                self.__tokens = min(self.__tokens, 1)
+
+                # Exponential backoff : 2, 4, 8... 60 seconds
+                pause = min(2 ** self.__nb_throttles_in_row, 60)
+            else:
+                pause = 0
+
+            retry_after = CKRateLimiter.__get_retry_after(response)
+            if retry_after is not None:
+                pause = max(pause, retry_after) if now >= self.__pause_end_time else retry_after
+
+            pause_end_time = now + pause
+            if pause_end_time > self.__pause_end_time:
+                self.throttled_time += pause_end_time - max(now, self.__pause_end_time)
+                self.__pause_end_time = pause_end_time
+
+        return True
+
+    # Get the Retry-After header in seconds (None if absent)
+    @staticmethod
+    def __get_retry_after(response):
+        retry_after = response.headers.get('Retry-After')
+        if not retry_after:
+            return None
+
+        if retry_after.isdigit():
+            return int(retry_after)
+
+        try:
+            return max((email.utils.parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+
+# Global bandwidth cap : token bucket of bytes shared by all the transfers
+# - every transfer takes the bytes it receives from the bucket, and waits (outside the lock) when the bucket is empty
+# - the bucket holds a quarter of second of bandwidth at most : no burst above the cap after an idle time
+class CKBandwidthLimiter:
+    # Constructor
+    # Arguments :
+    # - max_bandwidth : max number of bytes per second, all transfers together (no limit if omitted)
+    def __init__(self, max_bandwidth=None):
+        self.__lock = threading.Lock()
+        self.__max_bandwidth = max_bandwidth
+        self.__capacity = max(max_bandwidth / 4, 65536) if max_bandwidth else 0
+        self.__tokens = self.__capacity
+        self.__last_time = time.monotonic()
+        # Time the transfers waited, all threads together
+        self.waiting_time = 0
+
+    # Bytes received by a transfer : wait until the bandwidth allows them
+    def consume(self, nb_bytes):
+        if not self.__max_bandwidth:
+            return
+
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__last_time) * self.__max_bandwidth)
+            self.__last_time = now
+
+            # Bytes reserved : the transfers waiting together share the bandwidth
+            self.__tokens -= nb_bytes
+            wait_time = -self.__tokens / self.__max_bandwidth if self.__tokens < 0 else 0
+            self.waiting_time += wait_time
+
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# Data nodes of the site : the site redirects every /data URL to one of its data nodes (https://n1.coomer.su...)
+# - the nodes are found in the redirects (and kept in the persistent cache by CKUtils for the next runs)
+# - every node is probed once : latency and throughput of the first bytes of a file
+# - files are requested directly from the fastest healthy node : shortest estimated time for PROBE_SIZE bytes, longer with every transfer
+#   in progress on the node (parallel transfers are spread over the nodes)
+# - the latency and the throughput of a node are updated with its responses and its transfers
+# - a failing node (connection error, throttled, server error) is put aside for a while, doubled at every failure in a row
+class CKDataNodes:
+    PROBE_SIZE = 256 * 1024
+    MIN_DOWN_TIME = 30
+    MAX_DOWN_TIME = 600
+
+    # Constructor
+    # Arguments :
+    # - probe : function(node, path) probing a node with the file at the /data path,
+    #           returns (latency in seconds, throughput in bytes per second or None if unknown), None if the node failed
+    # - load_nodes : function returning the node URLs already known ("https://n1.coomer.su"...), called on first use
+    def __init__(self, probe, load_nodes=None):
+        self.__lock = threading.Lock()
+        self.__probe = probe
+        self.__load_nodes = load_nodes
+        self.__probing = False
+        # {node: {"latency": seconds, "throughput": bytes per second, "active": transfers in progress, "failures": failures in a row,
+        #         "down_until": monotonic time, "probed": bool, "seen": bool (in a redirect of this run)}}
+        self.__nodes = {}
+
+    # Get the node of a data file URL (None if the URL is not a /data URL)
+    @staticmethod
+    def get_url_node(url):
+        match = re.match(r'(https?://[^/]+)/data/', url)
+        return match.group(1) if match else None
+
+    # Add a node seen in a redirect
+    # Returns True if the node is seen for the first time in this run
+    def add_node(self, node):
+        self.__load()
+
+        with self.__lock:
+            stats = self.__nodes.setdefault(node, CKDataNodes.__new_stats())
+            seen = stats["seen"]
+            stats["seen"] = True
+            return not seen
+
+    @staticmethod
+    def __new_stats():
+        return {"latency": None, "throughput": None, "active": 0, "failures": 0, "down_until": 0, "probed": False, "seen": False}
+
+    # Add the nodes already known, once
+    def __load(self):
+        with self.__lock:
+            load_nodes = self.__load_nodes
+            self.__load_nodes = None
+
+        if load_nodes:
+            nodes = load_nodes()
+            with self.__lock:
+                for node in nodes:
+                    self.__nodes.setdefault(node, CKDataNodes.__new_stats())
+
+    # Get the fastest healthy node, the nodes not probed yet being probed first with a file
+    # Arguments :
+    # - path : /data path of the file
+    # - excluded_nodes : nodes not to use (already tried for the file)
+    #
+    # Returns node URL, None if no healthy node is known
+    def get_best_node(self, path, excluded_nodes=()):
+        self.__load()
+        self.__probe_nodes(path)
+
+        with self.__lock:
+            now = time.monotonic()
+            best_node = None
+            best_score = None
+
+            for node, stats in self.__nodes.items():
+                # Nodes being probed by another thread are not used yet
+                if node in excluded_nodes or stats["down_until"] > now or not stats["probed"] or stats["latency"] is None:
+                    continue
+
+                score = (stats["latency"] + (CKDataNodes.PROBE_SIZE / stats["throughput"] if stats["throughput"] else 0)) * (1 + stats["active"])
+                if best_score is None or score < best_score:
+                    best_node = node
+                    best_score = score
+
+            return best_node
+
+    # Probe the nodes not probed yet, one thread at a time
+    def __probe_nodes(self, path):
+        with self.__lock:
+            nodes = [node for node, stats in self.__nodes.items() if not stats["probed"]]
+            if self.__probing or not nodes:
+                return
+            self.__probing = True
+
+        try:
+            for node in nodes:
+                result = self.__probe(node, path)
+
+                with self.__lock:
+                    stats = self.__nodes[node]
+                    stats["probed"] = True
+                    if result is None:
+                        self.__set_failed(stats)
+                    else:
+                        stats["latency"], stats["throughput"] = result
+        finally:
+            with self.__lock:
+                self.__probing = False
+
+    # Successful response of a node
+    # Arguments :
+    # - latency : time to the response headers in seconds
+    def response_received(self, node, latency):
+        with self.__lock:
+            stats = self.__nodes[node]
+            stats["failures"] = 0
+            stats["latency"] = latency if stats["latency"] is None else stats["latency"] * 0.8 + latency * 0.2
+
+    # Failure of a node : put aside for a while
+    def node_failed(self, node):
+        with self.__lock:
+            self.__set_failed(self.__nodes[node])
+
+    @staticmethod
+    def __set_failed(stats):
+        stats["failures"] += 1
+        stats["down_until"] = time.monotonic() + min(CKDataNodes.MIN_DOWN_TIME * 2 ** (stats["failures"] - 1), CKDataNodes.MAX_DOWN_TIME)
+
+    # Transfer started from a node
+    def transfer_started(self, node):
+        with self.__lock:
+            self.__nodes[node]["active"] += 1
+
+    # Transfer done, nb_bytes received in seconds (the throughput is updated by the transfers long enough to measure it)
+    def transfer_done(self, node, nb_bytes, seconds):
+        with self.__lock:
+            stats = self.__nodes[node]
+            stats["active"] -= 1
+            if nb_bytes >= CKDataNodes.PROBE_SIZE and seconds > 0:
+                throughput = nb_bytes / seconds
+                stats["throughput"] = throughput if stats["throughput"] is None else stats["throughput"] * 0.8 + throughput * 0.2
+
+    # Get the nodes and their statistics
+    # Returns {node: {"latency": seconds, "throughput": bytes per second, "down": bool}}
+    def get_nodes(self):
+        with self.__lock:
+            now = time.monotonic()
+            return {node: {"latency": stats["latency"], "throughput": stats["throughput"], "down": stats["down_until"] > now}
+                    for node, stats in self.__nodes.items()}
+
+
+# Files of a user directory, scanned once (os.scandir) at the first check : existing, .ignore and .tmp files are found in the index
+# instead of being checked on disk one by one.
+# - a directory is created once, the modification times of the directories are set once, when the index is flushed
+# - a file already having its modification time is not touched
+# - the paths written by the run, and the paths outside the directory, are checked on disk
+# Without scan, every check and every modification time is done on disk at once.
+class CKDirectoryIndex:
+    # Constructor
+    # Arguments :
+    # - root : user directory
+    # - scan : scan the directory at the first check (checks on disk if False)
+    def __init__(self, root, scan=True):
+        self.__root = os.path.normpath(root)
+        self.__scan = scan
+        # {path: (size, modification time)}
+        self.__files = None
+        # {directory: modification time (None if modified by the run)}
+        self.__directories = None
+        self.__written_paths = set()
+        # {directory: timestamp}, set by flush
+        self.__directory_times = {}
+        self.__lock = threading.Lock()
+
+    # Scan the directory tree (lock held)
+    def __load(self):
+        if self.__files is not None:
+            return
+
+        self.__files = {}
+        self.__directories = {}
+        try:
+            stack = [(self.__root, os.stat(self.__root).st_mtime)]
+        except FileNotFoundError:
+            return
+
+        while stack:
+            directory, mtime = stack.pop()
+            self.__directories[directory] = mtime
+
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((os.path.join(directory, entry.name), entry.stat(follow_symlinks=False).st_mtime))
+                    elif entry.is_file():
+                        file_stat = entry.stat()
+                        self.__files[os.path.join(directory, entry.name)] = (file_stat.st_size, file_stat.st_mtime)
+
+    # Get a file on disk
+    # Returns (size, modification time), None if the file does not exist
+    @staticmethod
+    def stat_file(path):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return None
+        return (file_stat.st_size, file_stat.st_mtime) if stat.S_ISREG(file_stat.st_mode) else None
+
+    # Get a file
+    # Returns (size, modification time), None if the file does not exist
+    def get_file(self, path):
+        if self.__scan:
+            path = os.path.normpath(path)
+            with self.__lock:
+                self.__load()
+                if path.startswith(self.__root + os.sep) and path not in self.__written_paths:
+                    return self.__files.get(path)
+
+        return CKDirectoryIndex.stat_file(path)
+
+    def is_file(self, path):
+        return self.get_file(path) is not None
+
+    # Record a file written by the run (downloaded, .tmp) : checked on disk from now on
+    def file_written(self, path):
+        if self.__scan:
+            path = os.path.normpath(path)
+            with self.__lock:
+                self.__written_paths.add(path)
+                if self.__directories is not None:
+                    self.__directories[os.path.dirname(path)] = None
+
+    # Create a directory and its parents, once
+    def makedirs(self, directory):
+        if not self.__scan:
+            os.makedirs(directory, exist_ok=True)
+            return
+
+        directory = os.path.normpath(directory)
+        with self.__lock:
+            self.__load()
+            if directory not in self.__directories:
+                os.makedirs(directory, exist_ok=True)
+                self.__directories[directory] = None
+
+    # Set the modification time of a file (not touched if it already has it)
+    def set_file_time(self, path, timestamp):
+        file = self.get_file(path) if self.__scan else None
+        if file is None or abs(file[1] - timestamp) >= 1:
+            os.utime(path, (timestamp, timestamp))
+
+    # Set the modification time of a directory, when the index is flushed (at once without scan)
+    def set_directory_time(self, directory, timestamp):
+        if not self.__scan:
+            os.utime(directory, (timestamp, timestamp))
+            return
+
+        with self.__lock:
+            self.__load()
+            self.__directory_times[os.path.normpath(directory)] = timestamp
+
+    # Set the modification times of the directories, once per directory, after their files are written
+    def flush(self):
+        with self.__lock:
+            directory_times = self.__directory_times
+            self.__directory_times = {}
+
+            for directory, timestamp in directory_times.items():
+                mtime = self.__directories.get(directory)
+                if mtime is not None and abs(mtime - timestamp) < 1:
+                    continue
+                try:
+                    os.utime(directory, (timestamp, timestamp))
+                except FileNotFoundError:
+                    continue
+                self.__directories[directory] = timestamp
+
+
+# File listed in a user's posts (see CKUtils.__get_user_files) : compact record, without a dictionary per file.
+# The fields are read as attributes or as keys (file["name"]) : the records are used as the file dictionaries they replace.
+# - name, path (/data path : content hash), type (File_type), post_id, post_title, added, published, size (None if not requested)
+# - full_path : URL of the file, built from the site URL shared by the files
+class CKFile:
+    __slots__ = ("name", "path", "type", "post_id", "post_title", "added", "published", "size", "site_url")
+
+    FIELDS = ("name", "path", "full_path", "type", "post_id", "post_title", "added", "published", "size")
+
+    def __init__(self, name, path, type, post_id, post_title, added, published, site_url, size=None):
+        self.name = name
+        self.path = path
+        self.type = type
+        self.post_id = post_id
+        # Interned : the files of a post, and posts with the same title, share it
+        self.post_title = sys.intern(post_title)
+        self.added = added
+        self.published = published
+        self.site_url = site_url
+        self.size = size
+
+    @property
+    def full_path(self):
+        return self.site_url + "/data" + self.path
+
+    def __getitem__(self, key):
+        if key not in CKFile.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in CKFile.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in CKFile.FIELDS and (key != "size" or self.size is not None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return [key for key in CKFile.FIELDS if key in self]
+
+    # Get the file as a dictionary (JSON), the type as a string
+    def to_dict(self):
+        file = {key: self[key] for key in self.keys()}
+        file["type"] = str(self.type)
+        return file
+
+    # Get a file from its dictionary (see to_dict)
+    @staticmethod
+    def from_dict(file):
+        site_url = file["full_path"][:-len("/data" + file["path"])]
+        return CKFile(file["name"], file["path"], CKUtils.File_type.from_str(file["type"]), file["post_id"], file["post_title"], file.get("added"),
+                      file.get("published"), site_url, file.get("size"))
+
+
+# Machine-readable output of the listings, written record by record as the posts are read (see CKUtils display methods)
+# - ndjson : one JSON object per line
+# - csv, tsv : a header line with the field names, then one line per record, fields quoted when they contain a separator or a quote
+# The fields of a listing are always the same and in the same order (FILE_FIELDS, LINK_FIELDS, COLLAB_FIELDS), missing values are
+# null (ndjson) or empty (csv, tsv).
+class CKOutput:
+    FORMATS = ["text", "ndjson", "csv", "tsv"]
+
+    FILE_FIELDS = ("user_id", "post_id", "published", "type", "size", "hash", "path", "name", "post_title", "url")
+    LINK_FIELDS = ("user_id", "post_id", "published", "link")
+    COLLAB_FIELDS = ("user_id", "collab", "exists", "url")
+
+    # Constructor
+    # Arguments :
+    # - output_format : ndjson, csv or tsv
+    # - stream : text stream (standard output if omitted)
+    def __init__(self, output_format, stream=None):
+        self.__format = output_format
+        self.__stream = stream or sys.stdout
+        self.__csv_writer = None
+        self.__header_written = False
+
+        if output_format in ("csv", "tsv"):
+            self.__csv_writer = csv.writer(self.__stream, delimiter="," if output_format == "csv" else "\t", lineterminator="\n")
+
+    # Write a record, flushed at once : the readers of the output get it without waiting for the end of the listing
+    # Arguments :
+    # - fields : field names (see FILE_FIELDS...)
+    # - values : values of the fields
+    def write(self, fields, values):
+        if self.__format == "ndjson":
+            self.__stream.write(json.dumps(dict(zip(fields, values)), ensure_ascii=False) + "\n")
+        else:
+            if not self.__header_written:
+                self.__csv_writer.writerow(fields)
+                self.__header_written = True
+            self.__csv_writer.writerow(["" if value is None else str(value).lower() if isinstance(value, bool) else value for value in values])
+
+        self.__stream.flush()
 
 
 class CKUtils:
     # Constructor
-    def __init__(self, site, service, username="", password=""):
+    # Arguments :
+    # - max_per_host : max number of parallel downloads from the same host (no limit if omitted)
+    # - pool_size : max number of kept-alive connections per host (should be at least the number of parallel downloads)
+    # - timeout : connect and read timeout of every request, in seconds
+    # - cache_dir : directory of the persistent cache (~/.cache/ckutils if omitted)
+    # - prefetch : fetch the next page of posts while the current one is processed
+    # - offline : read the user's posts from the local index only, without any request
+    # - max_age : read the user's posts from the local index, synchronized first if older than max_age seconds (index not used if omitted)
+    # - max_rate : max number of requests per second to the site, all threads together (no limit if omitted)
+    # - segments : number of byte ranges downloaded in parallel for a large file (1 : one stream)
+    # - segment_threshold : min size of a file downloaded by segments, in bytes
+    # - collab_ttl : time in seconds during which user checks and the posts read by the collab crawl are cached
+    # - journal : keep a download journal in each user directory (see CKJournal), an interrupted run is resumed without listing the posts again
+    # - recheck : check on disk (and set the modification time of) the files completed according to the journal
+    # - verify : check the content hash of the downloaded files (computed while they are written) before renaming them
+    # - store_dir : directory of the content-addressed store : files are downloaded once, by content hash, and linked into the post directories
+    #               (no store if omitted)
+    # - max_bandwidth : max number of bytes per second downloaded, all transfers together (no limit if omitted)
+    # - data_nodes : request the files directly from the fastest data node of the site (see CKDataNodes), the site redirecting to a node otherwise
+    # - dir_index : scan each user directory once before its downloads (see CKDirectoryIndex), files are checked on disk one by one otherwise
+    def __init__(self, site, service, username="", password="", max_per_host=None, pool_size=10, timeout=60, cache_dir=None, prefetch=True,
+                 offline=False, max_age=None, max_rate=None, segments=1, segment_threshold=100 * 1024 * 1024, collab_ttl=7 * 24 * 3600,
+                 journal=True, recheck=False, verify=True, store_dir=None, max_bandwidth=None, data_nodes=True,
+                 dir_index=False):
+
+        load_dependencies()
 
         self.__site = site
+        # Site URL, https unless the site is given with its scheme (http://localhost:8000 for a test server)
+        self.__site_url = site if re.match(r'https?://', site) else "https://" + site
         self.__service = service
         self.__session_token = "anonymous"
+        self.__max_per_host = max_per_host
+        self.__host_slots = {}
+        self.__host_slots_lock = threading.Lock()
+        self.__timeout = timeout
+        self.__prefetch = prefetch
+        self.__offline = offline
+        self.__max_age = max_age
+        self.__rate_limiter = CKRateLimiter(max_rate)
+        self.__bandwidth_limiter = CKBandwidthLimiter(max_bandwidth)
+        self.__metrics = CKMetrics()
+        self.__segments = segments
+        self.__segment_threshold = segment_threshold
+        self.__collab_ttl = collab_ttl
+        self.__journal = journal
+        self.__recheck = recheck
+        self.__verify = verify
+        self.__store_dir = store_dir
+        # Files being written : {file name: [lock, number of users]} (see __lock_file)
+        self.__file_locks = {}
+        self.__file_locks_lock = threading.Lock()
+        self.__cache_dir = cache_dir or os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ckutils")
+        # [cache], opened on first use and shared with the with_service copies
+        self.__cache = [None]
+        self.__cache_lock = threading.Lock()
+        self.__data_nodes = CKDataNodes(self.__probe_data_node, self.__load_data_nodes) if data_nodes else None
+        self.__dir_index = dir_index
+        self.__dir_indexes = {}
+        self.__dir_indexes_lock = threading.Lock()
+
+        # Shared session : connections (and TLS handshakes) are reused by all the requests
+        self.__session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__session.mount("https://", adapter)
+        self.__session.mount("http://", adapter)
 
         credentialsData = None
         headers = None
@@ -28,31 +1384,102 @@ class CKUtils:
             credentialsData = {"username": username,"password": password}
             headers = {"accept" : "application/json", "Content-Type" : "application/json"}
 
-            response = requests.post("https://" + site + "/api/v1/authentication/login", json=credentialsData, headers=headers)
+            response = self.__request('POST', self.__site_url + "/api/v1/authentication/login", kind="login", json=credentialsData, headers=headers)
 
             if response.status_code == 200:
                 self.__session_token = re.sub(r'.*session=([^;]*).*', r'\1', response.headers["Set-Cookie"])
             else:
-                print("HTTP Error : " + response.reason + " (" + str(response.status_code) + ")")
+                message = "HTTP Error : " + response.reason + " (" + str(response.status_code) + ")"
                 if response.json() and 'error' in response.json():
-                    print("Functional error : " + response.json()['error'])
+                    message += "\nFunctional error : " + response.json()['error']
+
+                raise CKError(message, 2)
 
-                sys.exit(2)
+        # Session cookie sent with every request to the site (and not to other hosts)
+        self.__session.cookies.clear()
+        self.__session.cookies.set("session", self.__session_token, domain=urllib.parse.urlparse(self.__site_url).hostname)
+
+    # Send a request through the shared session
+    # Arguments :
+    # - kind : request kind in the metrics (see CKMetrics.request_done)
+    # - adapt_rate : slow down all the requests if the response is throttled (a throttling data node is put aside instead, see CKDataNodes)
+    def __request(self, method, url, kind="api", adapt_rate=True, **kwargs):
+        self.__rate_limiter.acquire()
+
+        kwargs.setdefault("timeout", self.__timeout)
+        start_time = time.monotonic()
+        try:
+            response = self.__session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.__metrics.request_done(kind, "error", time.monotonic() - start_time)
+            raise
+        self.__metrics.request_done(kind, response.status_code, time.monotonic() - start_time)
+
+        # Slow down all the requests if the site throttles
+        if adapt_rate:
+            self.__rate_limiter.response(response)
+        return response
+
+    # Time spent waiting for the site to stop throttling, in seconds
+    def get_throttled_time(self):
+        return self.__rate_limiter.throttled_time
+
+    # Get the run metrics (see CKMetrics)
+    def get_metrics(self):
+        self.__metrics.set_throttling(self.__rate_limiter.nb_throttles, self.__rate_limiter.throttled_time)
+        self.__metrics.set_bandwidth_wait_time(self.__bandwidth_limiter.waiting_time)
+        return self.__metrics
+
+    # Get a CKUtils on another service of the site, sharing the session, the cache and the limits of this one
+    def with_service(self, service):
+        ckutils_service = copy.copy(self)
+        ckutils_service.__service = service
+        return ckutils_service
+
+    # Close the session connections and the cache
+    def close(self):
+        self.__session.close()
+
+        with self.__cache_lock:
+            if self.__cache[0] is not None:
+                self.__cache[0].close()
+                self.__cache[0] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # Get the persistent cache (opened on first use)
+    def __get_cache(self):
+        with self.__cache_lock:
+            if self.__cache[0] is None:
+                self.__cache[0] = CKCache(self.__cache_dir)
+            return self.__cache[0]
 
     # Call API
     def call_get_API(self, uri):
-        request_url = "https://" + self.__site + uri
+        request_url = self.__site_url + uri
         #print(request_url)
         
-        response = requests.get(request_url, cookies={'session': self.__session_token})
+        response = self.__request('GET', request_url)
+
+        # Throttled : try again when the rate limiter ends its pause
+        nbThrottles = 0
+        while CKRateLimiter.is_throttled(response) and nbThrottles < 10:
+            nbThrottles += 1
+            self.__metrics.retry("api")
+            response = self.__request('GET', request_url)
+
+        self.__metrics.add_bytes("api", len(response.content))
         return response.content
             
     # Get API version
     def get_API_version(self):
-        response = requests.get("https://" + self.__site + "/api/v1/app_version")
+        response = self.__request('GET', self.__site_url + "/api/v1/app_version")
         if response.status_code != 200:
-            print("Site '" + self.__site + "' not available : " + str(response.status_code))
-            sys.exit(1)
+            raise CKError("Site '" + self.__site + "' not available : " + str(response.status_code), 1)
         return response.text
 
     class File_type(Enum):
@@ -89,6 +1516,21 @@ class CKUtils:
 
     FAVORITES = "myFavoritePosts"
 
+    # Number of tries of a file download (connection errors, time outs...)
+    MAX_DOWNLOAD_RETRIES = 5
+
+    # Number of times a throttled file download is queued again
+    MAX_DOWNLOAD_REQUEUES = 5
+
+    # Time in seconds during which a data node seen in a redirect is kept for the next runs
+    DATA_NODE_TTL = 30 * 24 * 3600
+
+    # Download orders of the queue (see __get_download_priority)
+    DOWNLOAD_ORDERS = ["newest", "smallest", "type", "creator"]
+
+    # Download order "type" : images first, videos last
+    FILE_TYPE_PRIORITIES = {File_type.IMAGE: 0, File_type.DOCUMENT: 1, File_type.SOUND: 2, File_type.OTHER: 3, File_type.ARCHIVE: 4, File_type.VIDEO: 5}
+
     # Get file type
     def __get_file_type(self, file):
         file_extension = os.path.splitext(file["name"].lower())[1]
@@ -99,10 +1541,6 @@ class CKUtils:
 
         return CKUtils.File_type.OTHER
 
-    # Get file full path
-    def __get_file_full_path(self, file):
-        return "https://" + self.__site + "/data" + file["path"]
-
     # Get post clean post title
     def __get_post_title(self, post):
         post_title = post["title"]
@@ -128,47 +1566,282 @@ class CKUtils:
         return post_files
 
     # Get user name
+    # With the local index (see offline and max_age), the name is stored with user's posts : it is read from the index offline
     def __get_user_name(self, user_id):
-        profile = json.loads(ckutils.call_get_API("/api/v1/" + self.__service + "/user/" + user_id + "/profile"))
+        indexed = (self.__offline or self.__max_age is not None) and user_id != CKUtils.FAVORITES
+
+        if indexed and self.__offline:
+            user_name = self.__get_cache().get_user_name(self.__site, self.__service, user_id)
+            if user_name is None:
+                raise CKError("User '" + user_id + "' not in the local index, run once without --offline", 5)
+            return user_name
+
+        profile = json.loads(self.call_get_API("/api/v1/" + self.__service + "/user/" + user_id + "/profile"))
         #print(profile)
+
+        if indexed:
+            self.__get_cache().set_user_name(self.__site, self.__service, user_id, profile["name"])
+
         return profile["name"]
 
+    # Get a page of user's posts (50 posts from post_offset)
+    def __get_post_page(self, user_id, post_offset):
+        with self.__metrics.phase("posts"):
+            return json.loads(self.call_get_API("/api/v1/" + self.__service + "/user/" + user_id + "?o=" + str(post_offset)))
+
+    # Get user's post pages, the next page being fetched in background while the current one is processed (see prefetch)
+    #
+    # Arguments :
+    # - user_id : user ID
+    # - prefetch : fetch the next page in background (CKUtils setting if omitted)
+    # - post_offset : offset of the first page
+    # - known_pages : {offset: posts} pages already requested
+    #
+    # Returns generator of post lists, from the latest posts (from post_offset)
+    def __get_post_pages(self, user_id, prefetch=None, post_offset=0, known_pages=None):
+        if user_id == CKUtils.FAVORITES:
+            # No pagination
+            with self.__metrics.phase("posts"):
+                posts = json.loads(self.call_get_API("/api/v1/account/favorites?type=post"))
+            yield posts
+            return
+
+        if prefetch is None:
+            prefetch = self.__prefetch
+        known_pages = known_pages or {}
+
+        def get_post_page(post_offset):
+            if post_offset in known_pages:
+                return known_pages.pop(post_offset)
+            return self.__get_post_page(user_id, post_offset)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            next_posts = executor.submit(get_post_page, post_offset)
+
+            while True:
+                posts = next_posts.result()
+
+                # No more posts
+                if len(posts) == 0:
+                    return
+
+                # Load next 50 posts
+                post_offset += 50
+                if prefetch:
+                    next_posts = executor.submit(get_post_page, post_offset)
+
+                yield posts
+
+                if not prefetch:
+                    next_posts = executor.submit(get_post_page, post_offset)
+
+    # Get user's post pages from the local index, synchronized first if needed (see offline and max_age)
+    # Arguments :
+    # - user_id : user ID
+    # - max_age : synchronize if older than max_age seconds (CKUtils setting if omitted)
+    #
+    # Returns generator of post lists, from the latest posts
+    def __get_indexed_post_pages(self, user_id, max_age=None):
+        cache = self.__get_cache()
+        post_sync = cache.get_post_sync(self.__site, self.__service, user_id)
+        if max_age is None:
+            max_age = self.__max_age
+
+        if self.__offline:
+            if post_sync is None:
+                raise CKError("User '" + user_id + "' not in the local index, run once without --offline", 5)
+        elif post_sync is None or not post_sync["complete"] or time.time() - post_sync["synced_at"] > max_age:
+            self.__sync_user_posts(user_id, post_sync)
+
+        post_offset = 0
+
+        while True:
+            posts = cache.get_posts(self.__site, self.__service, user_id, post_offset, 50)
+            if len(posts) == 0:
+                return
+
+            yield posts
+            post_offset += 50
+
+    # Synchronize the local index with user's posts
+    # Arguments :
+    # - user_id : user ID
+    # - post_sync : last synchronization (see CKCache.get_post_sync)
+    #
+    # If the last synchronization is complete, only the new posts are requested : paging stops at the first known post.
+    # Otherwise all the posts are requested again.
+    def __sync_user_posts(self, user_id, post_sync):
+        cache = self.__get_cache()
+        batch = post_sync["batch"] + 1 if post_sync else 0
+
+        if post_sync and post_sync["complete"]:
+            # New posts are stored at the end, in one transaction, so that an interrupted synchronization leaves no gap
+            new_posts = []
+
+            # Usually one page is enough, do not prefetch the next one
+            for posts in self.__get_post_pages(user_id, prefetch=False):
+                known_post_ids = cache.get_known_post_ids(self.__site, self.__service, user_id, [post["id"] for post in posts])
+                new_posts.extend(itertools.takewhile(lambda post: post["id"] not in known_post_ids, posts))
+
+                if known_post_ids:
+                    break
+
+            cache.add_posts(self.__site, self.__service, user_id, new_posts, batch, complete=True)
+            return
+
+        # Full synchronization, stored page after page
+        post_position = 0
+
+        for posts in self.__get_post_pages(user_id):
+            cache.add_posts(self.__site, self.__service, user_id, posts, batch, post_position, complete=False)
+            post_position += len(posts)
+
+        cache.add_posts(self.__site, self.__service, user_id, [], batch, post_position, complete=True)
+
     # Get user's post
     # Arguments :
     # - user_id : user ID
     # - from_date : list from this date (all posts if omitted)
     # - from_post_id : list from post ID (all posts if omitted)
+    # - lean : in reverse order, the posts are kept without the fields not needed by the file listing (see __get_lean_post)
+    #
+    # Returns generator of posts (posts are yielded page after page, except in reverse order where all the posts are needed first)
+    def __get_user_posts(self, user_id, from_date=None, to_date=None, from_post_id=None, to_post_id=None, reverse_order=False, lean=False):
+        # Favorite posts are not paginated, they are not indexed
+        if (self.__offline or self.__max_age is not None) and user_id != CKUtils.FAVORITES:
+            post_pages = self.__get_indexed_post_pages(user_id)
+        elif (from_date or from_post_id) and user_id != CKUtils.FAVORITES:
+            # Paging starts near the first post to list instead of the latest post
+            post_pages = self.__seek_post_pages(user_id, from_date, from_post_id)
+        else:
+            post_pages = self.__get_post_pages(user_id)
+
+        posts = self.__filter_user_posts(post_pages, from_date, to_date, from_post_id, to_post_id)
+
+        if not reverse_order:
+            return posts
+
+        if not lean:
+            return reversed(list(posts))
+
+        # All the posts are kept in memory : only the fields used by the file listing, in tuples
+        lean_posts = [CKUtils.__get_lean_post(post) for post in posts]
+        return map(CKUtils.__get_post_from_lean, reversed(lean_posts))
+
+    # Get the fields of a post used by the file listing (see __get_posts_files) : (id, title, added, published, file, attachments),
+    # files being (name, path)
+    @staticmethod
+    def __get_lean_post(post):
+        return (post["id"], post["title"], post["added"], post["published"], (post["file"]["name"], post["file"]["path"]) if post["file"] else None,
+                tuple((attachment["name"], attachment["path"]) for attachment in post["attachments"]))
+
+    # Get a post from its lean fields (see __get_lean_post)
+    @staticmethod
+    def __get_post_from_lean(lean_post):
+        post_id, title, added, published, file, attachments = lean_post
+        return {"id": post_id, "title": title, "added": added, "published": published,
+                "file": {"name": file[0], "path": file[1]} if file else None,
+                "attachments": [{"name": name, "path": path} for name, path in attachments]}
+
+    # Get user's post pages from the first page that may contain the first post to list
+    # Arguments :
+    # - user_id : user ID
+    # - from_date, from_post_id : see __get_user_posts (the date of from_post_id is requested)
     #
-    # Returns list of posts
-    def __get_user_posts(self, user_id, from_date=None, to_date=None, from_post_id=None, to_post_id=None, reverse_order=False):
-        post_offset = 0;
-        post_list = []
+    # Returns generator of post lists (see __get_post_pages)
+    def __seek_post_pages(self, user_id, from_date=None, from_post_id=None):
+        if from_post_id:
+            post = self.__get_post(user_id, from_post_id)
+            if post and post.get("added"):
+                post_added_date = datetime.fromisoformat(post["added"])
+                from_date = min(from_date, post_added_date) if from_date else post_added_date
+
+        if not from_date:
+            return self.__get_post_pages(user_id)
+
+        known_pages = {}
+        with self.__metrics.phase("seek"):
+            post_offset = self.__seek_post_offset(user_id, from_date, known_pages)
+
+        return self.__get_post_pages(user_id, post_offset=post_offset, known_pages=known_pages)
+
+    # Find the offset of the first page to read for a date : pages are probed by galloping then by binary search on the "added" date of their
+    # last post. Posts are sorted from the latest, a page is "newer" if all its posts were added after the date.
+    # The probed pages are cached : new posts only move a newer page further, the next seek on a near date starts from there.
+    # Arguments :
+    # - user_id : user ID
+    # - date : date of the first post to list
+    # - known_pages : {offset: posts} filled with the probed pages
+    #
+    # Returns offset of the last newer page (one page of margin, the posts not being strictly sorted by "added" date), 0 if none
+    def __seek_post_offset(self, user_id, date, known_pages):
+        cache = self.__get_cache()
+
+        def is_newer(post_offset):
+            posts = self.__get_post_page(user_id, post_offset)
+            known_pages[post_offset] = posts
+            if not posts or not posts[-1]["added"]:
+                return False
 
-      
-                      
-        # Loop all the posts
-        while True:
-        
-            if user_id != CKUtils.FAVORITES:
-                posts = json.loads(ckutils.call_get_API("/api/v1/" + self.__service + "/user/" + user_id + "?o=" + str(post_offset)))
+            cache.set_post_offset(self.__site, self.__service, user_id, post_offset, posts[-1]["added"])
+            return datetime.fromisoformat(posts[-1]["added"]) > date
+
+        # Start from the last newer page known (checked : posts may have been deleted)
+        newer_offset = cache.get_newer_post_offset(self.__site, self.__service, user_id, date)
+        if newer_offset is None or not is_newer(newer_offset):
+            newer_offset = 0
+            if not is_newer(0):
+                return 0
+
+        # Galloping : 1, 2, 4, 8... pages further until a page that is not newer
+        step = 50
+        older_offset = newer_offset + step
+        while is_newer(older_offset):
+            newer_offset = older_offset
+            step *= 2
+            older_offset = newer_offset + step
+
+        # Binary search between the newer page and the page that is not
+        while older_offset - newer_offset > 50:
+            middle_offset = newer_offset + (older_offset - newer_offset) // 100 * 50
+            if is_newer(middle_offset):
+                newer_offset = middle_offset
             else:
-                # No pagination
-                if post_offset == 0:
-                    posts = json.loads(ckutils.call_get_API("/api/v1/account/favorites?type=post"))
-                else:
-                    posts = []
-            
-            # No more posts, exit function
-            if len(posts) == 0:
-                return post_list
-                    
+                older_offset = middle_offset
+
+        # Only the first two pages of the listing are kept
+        for post_offset in [post_offset for post_offset in known_pages if post_offset not in (newer_offset, newer_offset + 50)]:
+            del known_pages[post_offset]
+
+        return newer_offset
+
+    # Get a post (None if not available)
+    def __get_post(self, user_id, post_id):
+        try:
+            post = json.loads(self.call_get_API("/api/v1/" + self.__service + "/user/" + user_id + "/post/" + post_id))
+        except ValueError:
+            return None
+
+        # The post may be wrapped : {"post": {...}, ...}
+        if isinstance(post, dict) and isinstance(post.get("post"), dict):
+            post = post["post"]
+        return post if isinstance(post, dict) else None
+
+    # Filter user's posts
+    # Arguments :
+    # - post_pages : generator of post lists, from the latest posts
+    # - from_date, to_date, from_post_id, to_post_id : see __get_user_posts
+    #
+    # Returns generator of posts
+    def __filter_user_posts(self, post_pages, from_date=None, to_date=None, from_post_id=None, to_post_id=None):
+        # Loop all the posts
+        for posts in post_pages:
             for post in posts:
                 if post["added"]:
                     post_added_date = datetime.fromisoformat(post["added"])
                 else:
                     post_added_date = None
 
-                post_title = self.__get_post_title(post)
                 post_id = post["id"]
                 
                 # Skip posts until we find the first post matching the date or/and the post ID
@@ -176,19 +1849,13 @@ class CKUtils:
                     continue
                     
                 if (to_post_id and (to_post_id == post_id)) or ((to_date and (to_date > post_added_date))):
-                    return post_list
+                    return
                     
                 # From now, display all the files
                 from_post_id = None
                 from_date = None
                 
-                if not reverse_order:
-                    post_list.append(post)
-                else:
-                    post_list.insert(0, post)
-                    
-            # Load next 50 posts
-            post_offset += 50
+                yield post
 
 
     # Get user's files.
@@ -198,19 +1865,33 @@ class CKUtils:
     # - from_date : list from this date (all posts if omitted)
     # - from_post_id : list from post ID (all posts if omitted)
     # - get_size : get file size (False by default)
+    # - jobs : number of parallel file size requests
+    # - per_post : a content found in several posts is listed in each post (once for all the posts otherwise)
     #
-    # Returns list of files: [{"name": "string", "path": "string", "type": "string", "size": int, "post_id": string, "post_title": "string"}]
-    def __get_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, get_size=False, reverse_order=False):
-        post_offset = 0;
-        file_list = []
-        file_full_path_list = []
-        
-        # Loop all the posts
-        post_list = self.__get_user_posts(user_id, from_date, to_date, from_post_id, to_post_id, reverse_order)
-        
-        for post in post_list:
+    # Returns generator of files (CKFile : name, path, full_path, type, post_id, post_title, added, published, size if get_size)
+    def __get_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, get_size=False, reverse_order=False, jobs=1,
+                         per_post=False):
+        posts = self.__get_user_posts(user_id, from_date, to_date, from_post_id, to_post_id, reverse_order, lean=True)
+        files = self.__get_posts_files(posts, file_type, per_post)
+
+        if not get_size:
+            return files
+
+        return self.__get_files_with_size(files, jobs)
+
+    # Get the files of posts
+    # Arguments :
+    # - posts : generator of posts
+    # - file_type : File_type (all if omitted)
+    # - per_post : see __get_user_files
+    #
+    # Returns generator of files (see __get_user_files)
+    def __get_posts_files(self, posts, file_type=None, per_post=False):
+        # Hash index of the files already listed : the file name of the /data path is the content hash
+        file_keys = set()
+
+        for post in posts:
             post_title = self.__get_post_title(post)
-            post_id = post["id"]
             
             for file in self.__get_post_files(post):
                 post_file_type = self.__get_file_type(file)
@@ -219,51 +1900,120 @@ class CKUtils:
                 if file_type != None and (file_type != post_file_type):
                     continue
                 
-                file_info = {}
-                file_info["name"] = file["name"]
-                file_info["full_path"] = self.__get_file_full_path(file)
-                file_info["type"] = post_file_type
-                file_info["post_id"] = post["id"]
-                file_info["post_title"] = post_title
-                file_info["added"] = post["added"]
-                file_info["published"] = post["published"]
-                file_info["type"] = post_file_type
-                
-                # Get file size
-                if get_size:
-                    response = requests.request('HEAD', self.__get_file_full_path(file))
-                    size = response.headers["Content-Length"]
-                    file_info["size"] = int(size)
-                
                 # Avoid doublons
-                if not file_info["full_path"] in file_full_path_list:
-                    file_list.append(file_info)
-                    file_full_path_list.append(file_info["full_path"] )
-                
-        return file_list
+                file_key = (post["id"], os.path.basename(file["path"])) if per_post else os.path.basename(file["path"])
+                if not file_key in file_keys:
+                    file_keys.add(file_key)
+                    yield CKFile(file["name"], file["path"], post_file_type, post["id"], post_title, post["added"], post["published"], self.__site_url)
+
+    # Get the files with their size, sizes being requested by batches of files
+    #
+    # Returns generator of files (see __get_user_files)
+    def __get_files_with_size(self, files, jobs=1):
+        while True:
+            file_list = list(itertools.islice(files, 100))
+            if len(file_list) == 0:
+                return
+
+            with self.__metrics.phase("file_sizes"):
+                self.__set_file_sizes(file_list, jobs)
+            yield from file_list
+
+    # Set the "size" of the files : sizes already known are read from the cache, the others are requested in parallel
+    # Arguments :
+    # - file_list : files (see __get_user_files)
+    # - jobs : number of parallel requests
+    def __set_file_sizes(self, file_list, jobs=1):
+        cache = self.__get_cache()
+        file_sizes = cache.get_file_sizes(set(file["path"] for file in file_list))
+        missing_paths = {file["path"]: file["full_path"] for file in file_list if file["path"] not in file_sizes}
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = {executor.submit(self.__request_file_size, path, full_path): path for path, full_path in missing_paths.items()}
+            new_file_sizes = {}
+
+            for future in concurrent.futures.as_completed(futures):
+                size = future.result()
+                if size is None:
+                    continue
+
+                new_file_sizes[futures[future]] = size
+
+                # Save regularly, an interrupted run keeps what has been requested
+                if len(new_file_sizes) >= 100:
+                    cache.set_file_sizes(new_file_sizes)
+                    file_sizes.update(new_file_sizes)
+                    new_file_sizes = {}
+
+            cache.set_file_sizes(new_file_sizes)
+            file_sizes.update(new_file_sizes)
+
+        for file in file_list:
+            file["size"] = file_sizes.get(file["path"], 0)
+
+    # Request the size of a file (None if not available)
+    # Arguments :
+    # - path : /data path of the file
+    # - full_path : URL of the file on the site
+    def __request_file_size(self, path, full_path):
+        try:
+            response, url, node = self.__head_data_file(path, full_path, "file_size")
+        except (requests.exceptions.RequestException) as e:
+            print("Size not available (" + type(e).__name__ + ") : " + full_path, file=sys.stderr)
+            return None
+
+        if response.status_code != 200 or "Content-Length" not in response.headers:
+            print("Size not available (HTTP " + str(response.status_code) + ") : " + full_path, file=sys.stderr)
+            return None
+
+        return int(response.headers["Content-Length"])
 
     # Check API
+    # Returns True if the user exists, False if not, None if unknown (site errors)
     def __check_user_exists(self, user):
-        request_url = "https://" + self.__site + '/api/v1/' + self.__service + '/user/' + user + '/profile'
+        request_url = self.__site_url + '/api/v1/' + self.__service + '/user/' + user + '/profile'
         #print(request_url)
         
         nbTries = 0
+        nbThrottles = 0
         
-        while nbTries < 3:
-            response = requests.head(request_url)
-            response = requests.get(request_url)
-
-            if response.status_code == 200:
+        while nbTries < 3 and nbThrottles < 10:
+            if nbTries + nbThrottles > 0:
+                self.__metrics.retry("user_check")
+            try:
+                response = self.__request('GET', request_url, kind="user_check")
+            except (requests.exceptions.RequestException) as e:
+                response = None
+
+            if response is not None and response.status_code == 200:
                 return True
-            elif response.status_code == 404:
+            elif response is not None and response.status_code == 404:
                 return False
+            elif response is not None and CKRateLimiter.is_throttled(response):
+                # The rate limiter pauses all the requests
+                nbThrottles += 1
             else:
                 nbTries += 1
-                
-            time.sleep(3)
+                time.sleep(2 ** nbTries)
             
-        return False
+        return None
 
+    # Get user's name (name of the download directory)
+    def get_user_name(self, user_id):
+        return self.__get_user_name(user_id)
+
+    # Iterate over user's posts, page after page (see __get_user_posts for the arguments)
+    #
+    # Returns generator of posts as returned by the API
+    def iter_user_posts(self, user_id, from_date=None, to_date=None, from_post_id=None, to_post_id=None, reverse_order=False):
+        yield from self.__get_user_posts(user_id, from_date, to_date, from_post_id, to_post_id, reverse_order)
+
+    # Iterate over user's files (see __get_user_files for the arguments)
+    #
+    # Returns generator of files (see CKFile, read as attributes or as keys : file.name or file["name"])
+    def iter_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, get_size=False, reverse_order=False,
+                        jobs=8):
+        yield from self.__get_user_files(user_id, file_type, from_date, to_date, from_post_id, to_post_id, get_size, reverse_order, jobs)
 
     # Display user's files.
     # Arguments :
@@ -272,205 +2022,1274 @@ class CKUtils:
     # - from_date : list from this date (all posts if omitted)
     # - from_post_id : list from post ID (all posts if omitted)
     # - display_size : display file size with total at the end (False by default)
-    def display_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, display_size=False, reverse_order=False):
-        file_list = self.__get_user_files(user_id, file_type, from_date, to_date, from_post_id, to_post_id, display_size, reverse_order)
-        
+    # - jobs : number of parallel file size requests (8 by default)
+    # - output : CKOutput of the files (CKOutput.FILE_FIELDS, no total), colon separated lines if omitted
+    def display_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, display_size=False, reverse_order=False, jobs=8,
+                           output=None):
         total_size = 0
         string_size = ""
         
-        for file in file_list:
+        for file in self.__get_user_files(user_id, file_type, from_date, to_date, from_post_id, to_post_id, display_size, reverse_order, jobs):
+            if output:
+                output.write(CKOutput.FILE_FIELDS, (user_id, file.post_id, file.published, str(file.type), file.size, self.__get_expected_hash(file), file.path,
+                                                    file.name, file.post_title, file.full_path))
+                continue
+
             if display_size:
                 total_size += file["size"]
                 string_size = ":" + str(file["size"])
             
             print(file["published"] + ":" + str(file["type"]) + string_size + ":" + file["post_title"] + ":" + file["full_path"] + ":" + file["name"])
             
-        if display_size:
+        if display_size and not output:
             print("Total size:" + str(total_size))
                                  
+    # Verify user's downloaded files : the content of every file is hashed again and compared with the hash of its /data path.
+    # Files are hashed by a pool of processes with memory-mapped reads.
+    # Arguments :
+    # - user_id : user ID
+    # - file_type, from_date, to_date, from_post_id, to_post_id : filters of download_user_files
+    # - jobs : number of processes (number of CPUs if omitted)
+    #
+    # Returns the number of files not matching their hash or not readable
+    def verify_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, jobs=None):
+        user_name = self.__get_user_name(user_id)
+        file_names = []
+        expected_hashes = []
+        nb_missing_files = 0
+        nb_unverifiable_files = 0
+
+        for file in self.__get_user_files(user_id, file_type, from_date, to_date, from_post_id, to_post_id, per_post=self.__store_dir is not None):
+            directory_name, file_name = self.__get_download_file_name(user_name, file)
+
+            if not os.path.isfile(file_name):
+                if not os.path.isfile(file_name + ".ignore"):
+                    nb_missing_files += 1
+                continue
+
+            expected_hash = CKUtils.__get_expected_hash(file)
+            if expected_hash is None:
+                nb_unverifiable_files += 1
+                continue
+
+            file_names.append(file_name)
+            expected_hashes.append(expected_hash)
+
+        nb_mismatches = 0
+        nb_read_errors = 0
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for file_name, expected_hash, file_hash in zip(file_names, expected_hashes, executor.map(CKUtils.get_file_hash, file_names, chunksize=16)):
+                if file_hash is None:
+                    nb_read_errors += 1
+                    print("Read error : '" + file_name + "'")
+                elif file_hash != expected_hash:
+                    nb_mismatches += 1
+                    print("Hash mismatch : '" + file_name + "'")
+
+        print("Verified : " + str(len(file_names)) + " file(s), mismatches " + str(nb_mismatches) + ", read errors " + str(nb_read_errors) + ", " +
+              "missing " + str(nb_missing_files) + ", not verifiable " + str(nb_unverifiable_files))
+
+        return nb_mismatches + nb_read_errors
+
     # Download user's files.
     # - user_id : user ID
     # - file_type : File_type (all if omitted)
     # - from_date : list from this date (all posts if omitted)
     # - from_post_id : list from post ID (all posts if omitted)
     # - overwrite_file : if false, do not download if file already exists.
-    def download_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, overwrite_file=False, reverse_order=False, quiet=False):
-        file_list = self.__get_user_files(user_id, file_type, from_date, to_date, from_post_id, to_post_id, get_size=False, reverse_order=reverse_order)
-        user_name = self.__get_user_name(user_id)
+    # - jobs : number of files downloaded in parallel (1 by default)
+    # - order : list of DOWNLOAD_ORDERS, files downloaded by priority instead of the listing order (see __get_download_priority)
+    def download_user_files(self, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, overwrite_file=False, reverse_order=False, quiet=False, jobs=1,
+                            order=None):
+        # Details, displayed at the end : files are downloaded while the posts are listed
+        stats = CKDownloadStats()
+
+        # Sequential download, one progress bar per file (a download order needs the queue)
+        if jobs <= 1 and not order:
+            user_name = self.__get_user_name(user_id)
+            journal = self.__open_journal(user_name, file_type, from_date, to_date, from_post_id, to_post_id)
+
+            # Run completed : not resumed by the next run (see CKJournal)
+            completed = False
+            try:
+                # Throttled files are downloaded after the others
+                throttled_files = []
+
+                files = self.__get_files_to_download(journal, user_id, file_type, from_date, to_date, from_post_id, to_post_id, reverse_order)
+
+                for file in self.__journal_files_queued(journal, user_name, files, overwrite_file):
+                    stats.file_queued(file["type"])
+                    status = self.__download_file(user_name, file, overwrite_file, quiet, stats=stats, journal=journal)
+                    if status == "throttled":
+                        throttled_files.append(file)
+                    else:
+                        self.__file_done(user_name, file, status, stats, journal=journal)
+
+                for nb_requeues in range(CKUtils.MAX_DOWNLOAD_REQUEUES):
+                    files = throttled_files
+                    throttled_files = []
+
+                    for file in files:
+                        self.__metrics.retry("requeue")
+                        status = self.__download_file(user_name, file, overwrite_file, quiet, stats=stats, journal=journal)
+                        if status == "throttled":
+                            throttled_files.append(file)
+                        else:
+                            self.__file_done(user_name, file, status, stats, journal=journal)
+
+                for file in throttled_files:
+                    self.__file_done(user_name, file, "failed", stats, journal=journal)
+
+                completed = True
+            finally:
+                if journal:
+                    journal.close(completed)
+                self.__close_dir_indexes()
+
+        # Parallel download, one progress bar for all the files
+        else:
+            progress = CKProgress()
+            download_queue = CKDownloadQueue(max(jobs, 1), max_pending=CKUtils.__get_max_pending_files(jobs, order))
+            journals = []
+
+            # Listing error or program stopped : the queued files are dropped, the journals resume them in the next run
+            completed = False
+            try:
+                self.__queue_user_files(download_queue, progress, stats, journals, user_id, file_type, from_date, to_date, from_post_id, to_post_id, overwrite_file,
+                                        reverse_order, quiet, order)
+                download_queue.join()
+                completed = True
+            finally:
+                download_queue.close(cancel=not completed)
+                progress.close()
+
+                for journal in journals:
+                    journal.close(completed and stats.listing_completed)
+                self.__close_dir_indexes()
+
+        for nb_files in stats.nb_files_per_type:
+            print("Nb " + nb_files + "(s) : " + str(stats.nb_files_per_type[nb_files]))
+
+        if self.__store_dir:
+            self.__display_dedup_report([stats])
+
+    # Display the deduplication by the content-addressed store
+    # Arguments :
+    # - stats_list : CKDownloadStats of the users
+    def __display_dedup_report(self, stats_list):
+        nb_linked_files = sum(stats.nb_files_per_status.get("linked", 0) for stats in stats_list)
+        nb_linked_bytes = sum(stats.nb_linked_bytes for stats in stats_list)
+        nb_downloaded_files = sum(stats.nb_files_per_status.get("downloaded", 0) for stats in stats_list)
 
-        # Details
-        nb_files_per_type = {}
-        for file in file_list:
-            if file['type'].value['type'] in nb_files_per_type:
-                nb_files_per_type[file['type'].value['type']] += 1
-            else:
-                nb_files_per_type[file['type'].value['type']] = 1
+        print("Deduplicated : " + str(nb_linked_files) + " file(s) linked from the store, " + str(nb_linked_bytes) + " bytes not downloaded " +
+              "(" + str(nb_downloaded_files) + " file(s) downloaded into the store)")
+
+    # Download the files of several users, all the downloads sharing the same queue of workers.
+    # Arguments :
+    # - entries : list of {"user_id": "string", "service": "string", ...} with the filters of download_user_files (file_type, from_date, to_date,
+    #             from_post_id, to_post_id, reverse_order), service being the CKUtils service if omitted
+    #             and "priority" for the order "creator" (lowest first, the order of the entries if omitted)
+    # - overwrite_file : if false, do not download if file already exists.
+    # - jobs : number of files downloaded in parallel, all users together
+    # - order : see download_user_files
+    #
+    # A summary per user is displayed at the end.
+    def download_users_files(self, entries, overwrite_file=False, quiet=False, jobs=1, order=None):
+        jobs = max(jobs, 1)
+        progress = CKProgress()
+        download_queue = CKDownloadQueue(jobs, max_pending=CKUtils.__get_max_pending_files(jobs, order))
+        stats_list = [CKDownloadStats() for entry in entries]
+        journals = [[] for entry in entries]
+
+        # Users are listed in parallel : the queue mixes their files so that every user progresses
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(entries), jobs) or 1)
+
+        # Program stopped : the queued files are dropped (the listings waiting for a place in the queue end), the journals resume them in the next run
+        completed = False
+        try:
+            futures = []
+
+            for index, (entry, stats, user_journals) in enumerate(zip(entries, stats_list, journals)):
+                filters = {key: value for key, value in entry.items() if key not in ("service", "user_id", "priority")}
+                ckutils_service = self.with_service(entry.get("service") or self.__service)
+                futures.append(executor.submit(ckutils_service.__queue_user_files, download_queue, progress, stats, user_journals, entry["user_id"],
+                                               overwrite_file=overwrite_file, quiet=quiet, order=order, creator_priority=entry.get("priority", index),
+                                               **filters))
+
+            for entry, future in zip(entries, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    progress.write("Listing error, user '" + entry["user_id"] + "' : " + type(e).__name__ + " (" + str(e) + ")")
+
+            download_queue.join()
+            completed = True
+        finally:
+            download_queue.close(cancel=not completed)
+            executor.shutdown()
+            progress.close()
+
+            for stats, user_journals in zip(stats_list, journals):
+                for journal in user_journals:
+                    journal.close(completed and stats.listing_completed)
+            self.__close_dir_indexes()
+
+        # Summary
+        print("Summary :")
+        for entry, stats in zip(entries, stats_list):
+            print((entry.get("service") or self.__service) + "/" + entry["user_id"] + " : " +
+                  "files " + str(stats.nb_files) + ", " +
+                  "downloaded " + str(stats.nb_files_per_status.get("downloaded", 0)) + ", " +
+                  ("linked " + str(stats.nb_files_per_status.get("linked", 0)) + ", " if self.__store_dir else "") +
+                  "skipped " + str(stats.nb_files_per_status.get("skipped", 0) + stats.nb_files_per_status.get("ignored", 0)) + ", " +
+                  "failed " + str(stats.nb_files_per_status.get("failed", 0) + (0 if stats.listing_completed else 1)) + ", " +
+                  "bytes " + str(stats.nb_bytes) + ", " +
+                  "time " + str(round(stats.get_wall_time(), 1)) + "s")
+
+        if self.__store_dir:
+            self.__display_dedup_report(stats_list)
+
+    # Queue the download of user's files (see download_user_files for the arguments)
+    # Arguments :
+    # - download_queue : CKDownloadQueue
+    # - progress : CKProgress
+    # - stats : CKDownloadStats of the user
+    # - journals : list where the user's journal is added, to be closed when the downloads are done
+    # - order : see download_user_files
+    # - creator_priority : priority of the user for the order "creator"
+    def __queue_user_files(self, download_queue, progress, stats, journals, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None,
+                           to_post_id=None, overwrite_file=False, reverse_order=False, quiet=False, order=None, creator_priority=0):
+        completed = False
+        try:
+            user_name = self.__get_user_name(user_id)
+            journal = self.__open_journal(user_name, file_type, from_date, to_date, from_post_id, to_post_id)
+            if journal:
+                journals.append(journal)
+
+            files = self.__get_files_to_download(journal, user_id, file_type, from_date, to_date, from_post_id, to_post_id, reverse_order,
+                                                 get_size=bool(order) and "smallest" in order)
+
+            for file in self.__journal_files_queued(journal, user_name, files, overwrite_file):
+                stats.file_queued(file["type"])
+                progress.add_file()
+                download_queue.put(lambda file=file, nb_requeues=[0]: self.__download_task(user_name, file, overwrite_file, quiet, progress, stats, journal,
+                                                                                           nb_requeues),
+                                   self.__get_download_priority(file, order, creator_priority))
+
+            completed = True
+        finally:
+            stats.listing_done(completed)
+
+    # Get the max number of files waiting in the download queue
+    # Arguments :
+    # - jobs : number of parallel downloads
+    # - order : see download_user_files
+    @staticmethod
+    def __get_max_pending_files(jobs, order=None):
+        # Ordered downloads : the whole listing is queued, to be sorted
+        if order:
+            return None
+
+        # Bounded queue : the listing does not get too far ahead of the downloads
+        return max(jobs, 1) * 4
+
+    # Get the priority of a file in the download queue, lowest first (tuple of the orders, in the order given)
+    # - newest : latest publication first
+    # - smallest : smallest file first (files of unknown size last)
+    # - type : by FILE_TYPE_PRIORITIES (images first, videos last)
+    # - creator : by creator_priority (the order of the batch entries)
+    # Arguments :
+    # - file : file to download (see __get_user_files)
+    # - order : list of DOWNLOAD_ORDERS (listing order if omitted)
+    # - creator_priority : priority of the file's user
+    def __get_download_priority(self, file, order=None, creator_priority=0):
+        priority = []
+
+        for download_order in order or []:
+            if download_order == "newest":
+                priority.append(-datetime.fromisoformat(file["published"]).timestamp())
+            elif download_order == "smallest":
+                priority.append(file["size"] if file.get("size") else float("inf"))
+            elif download_order == "type":
+                priority.append(CKUtils.FILE_TYPE_PRIORITIES.get(file["type"], len(CKUtils.FILE_TYPE_PRIORITIES)))
+            elif download_order == "creator":
+                priority.append(creator_priority)
+
+        return tuple(priority)
+
+    # Open the download journal of a user (None if the journal is disabled)
+    # Arguments : user_name and the filters of download_user_files
+    def __open_journal(self, user_name, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None):
+        if not self.__journal:
+            return None
+
+        filters = {"site": self.__site, "service": self.__service, "file_type": str(file_type) if file_type else None,
+                   "from_date": str(from_date) if from_date else None, "to_date": str(to_date) if to_date else None,
+                   "from_post_id": from_post_id, "to_post_id": to_post_id}
+        return CKJournal(requests.utils.unquote(user_name), filters)
+
+    # Get the files to download : the unfinished files of an interrupted run if the journal resumes it (no request), user's files otherwise
+    # Arguments : journal (None if disabled), the filters of download_user_files and get_size (files with their size, see __get_user_files)
+    def __get_files_to_download(self, journal, user_id, file_type=None, from_date=None, to_date=None, from_post_id=None, to_post_id=None, reverse_order=False,
+                                get_size=False):
+        if journal and journal.resume_only:
+            files = journal.get_unfinished_files()
+            print("Resume the interrupted download : " + str(len(files)) + " file(s) left")
+            files = (CKFile.from_dict(file) for file in files)
+            return self.__get_files_with_size(files, 8) if get_size else files
+
+        # With the store, a content found in several posts is linked into each post directory
+        return self.__get_user_files(user_id, file_type, from_date, to_date, from_post_id, to_post_id, get_size=get_size, reverse_order=reverse_order,
+                                     jobs=8, per_post=self.__store_dir is not None)
+
+    # Record the listing in the journal before any download : an interrupted run is then resumed without listing the posts again, whatever the
+    # number of files downloaded (files completed by a previous run are not recorded again, unless downloaded again : overwrite_file or recheck)
+    # Arguments :
+    # - journal : CKJournal of the user (None if disabled)
+    # - files : files to download (see __get_files_to_download)
+    #
+    # Returns the files (list of all the files with the journal, files as is otherwise)
+    def __journal_files_queued(self, journal, user_name, files, overwrite_file=False):
+        if not journal:
+            return files
+
+        files = list(files)
+
+        for file in files:
+            directory_name, file_name = self.__get_download_file_name(user_name, file)
+            if overwrite_file or self.__recheck or not journal.is_completed(file_name):
+                journal.file_queued(file_name, file)
+
+        journal.listing_done()
+        return files
+
+    # File processed : statistics, metrics and journal
+    def __file_done(self, user_name, file, status, stats, journal=None):
+        stats.file_done(status)
+        self.__metrics.file_done(status)
+        if journal:
+            directory_name, file_name = self.__get_download_file_name(user_name, file)
+            journal.file_done(file_name, status)
+
+    # Download one file from the queue
+    # Arguments :
+    # - nb_requeues : [number of times the file has been queued again]
+    #
+    # Returns CKDownloadQueue.REQUEUE if the file is throttled
+    def __download_task(self, user_name, file, overwrite_file, quiet, progress, stats, journal, nb_requeues):
+        status = "failed"
+        try:
+            status = self.__download_file(user_name, file, overwrite_file, quiet, progress, stats, journal)
+
+            # Throttled : queued again, the rate limiter pauses the requests meanwhile
+            if status == "throttled":
+                if nb_requeues[0] < CKUtils.MAX_DOWNLOAD_REQUEUES:
+                    nb_requeues[0] += 1
+                    self.__metrics.retry("requeue")
+                    return CKDownloadQueue.REQUEUE
+                status = "failed"
+        finally:
+            if status != "throttled":
+                progress.file_done(status)
+                self.__file_done(user_name, file, status, stats, journal)
+
+    # Download a file by segments : byte ranges downloaded in parallel into the preallocated .tmp file.
+    # The progress of each segment is saved in a .tmp.parts file, an interrupted download resumes every segment.
+    # Arguments :
+    # - node : data node of the URL (None if the URL is on the site), its errors raise CKDataNodeError
+    # - url : file URL
+    # - file_name : downloaded file name (the data is written in file_name + ".tmp")
+    # - total_size : file size
+    # - progress : CKProgress shared by parallel downloads (one progress bar for the file if omitted)
+    # - stats : CKDownloadStats of the user
+    # - received : [number of bytes received for the file], incremented with the bytes of the segments
+    #
+    # Returns "completed", "incomplete", "throttled" or "unsupported" (the server ignores byte ranges, nothing written)
+    def __download_segments(self, node, url, file_name, total_size, progress=None, stats=None, received=None):
+        file_name_tmp = file_name + ".tmp"
+        parts_file_name = file_name_tmp + ".parts"
+        segments = None
+
+        # Resume : [start, end, nb bytes downloaded] of each segment
+        if os.path.isfile(file_name_tmp) and os.path.isfile(parts_file_name):
+            with open(parts_file_name) as parts_file:
+                parts = json.load(parts_file)
+            if parts["size"] == total_size:
+                segments = parts["segments"]
+
+        if segments is None:
+            # Check that the server supports byte ranges
+            with self.__get_data_file(node, url, "file_range", stream=True, headers={"Range": "bytes=0-0"}) as response:
+                if node and (response.status_code not in (200, 206) or CKRateLimiter.is_throttled(response)):
+                    raise CKDataNodeError("HTTP error " + str(response.status_code) + " from data node " + node)
+                if CKRateLimiter.is_throttled(response):
+                    return "throttled"
+                if response.status_code != 206:
+                    return "unsupported"
+
+            segment_size = -(-total_size // self.__segments)
+            segments = [[start, min(start + segment_size, total_size) - 1, 0] for start in range(0, total_size, segment_size)]
+
+            with open(file_name_tmp, "wb") as file_object:
+                file_object.truncate(total_size)
+
+        lock = threading.Lock()
+        errors = []
+        last_save_time = [time.monotonic()]
+
+        def save_parts():
+            with open(parts_file_name + ".new", "w") as parts_file:
+                json.dump({"size": total_size, "segments": segments}, parts_file)
+            os.replace(parts_file_name + ".new", parts_file_name)
+
+        save_parts()
+
+        already_downloaded = sum(segment[2] for segment in segments)
+        if progress:
+            progress.add_size(total_size, already_downloaded)
+            bar = None
+        else:
+            bar = tqdm(desc=file_name, total=total_size, unit='B', unit_scale=True, unit_divisor=1024, initial=already_downloaded)
+
+        def download_segment(segment):
+            nb_bytes = 0
+            disk_write_time = 0
+            try:
+                start, end = segment[0], segment[1]
+                if start + segment[2] > end:
+                    return
+
+                with self.__get_data_file(node, url, "file_range", stream=True, headers={"Range": "bytes=" + str(start + segment[2]) + "-" + str(end)}) as response:
+                    if node and (response.status_code != 206 or CKRateLimiter.is_throttled(response)):
+                        raise CKDataNodeError("HTTP error " + str(response.status_code) + " from data node " + node)
+                    if response.status_code != 206:
+                        raise requests.exceptions.HTTPError("HTTP error " + str(response.status_code) + " on byte range", response=response)
+
+                    # Unbuffered : the saved progress never exceeds the data written
+                    with open(file_name_tmp, "r+b", buffering=0) as file_object:
+                        file_object.seek(start + segment[2])
+
+                        for data in response.iter_content(chunk_size=65536):
+                            data = data[:end + 1 - start - segment[2]]
+                            if not data:
+                                break
+                            write_time = time.perf_counter()
+                            file_object.write(data)
+                            disk_write_time += time.perf_counter() - write_time
+                            nb_bytes += len(data)
+
+                            self.__bandwidth_limiter.consume(len(data))
+
+                            with lock:
+                                segment[2] += len(data)
+                                if progress:
+                                    progress.update(len(data))
+                                else:
+                                    bar.update(len(data))
+                                if stats:
+                                    stats.add_bytes(len(data))
+
+                                if time.monotonic() - last_save_time[0] >= 1:
+                                    save_parts()
+                                    last_save_time[0] = time.monotonic()
+
+            except Exception as e:
+                errors.append(e)
+            finally:
+                self.__metrics.add_bytes("file_range", nb_bytes)
+                self.__metrics.add_disk_write_time(disk_write_time)
+                if received is not None:
+                    with lock:
+                        received[0] += nb_bytes
+
+        # Daemon threads : Ctrl-C does not wait for the segments, the saved progress is resumed next time
+        threads = [threading.Thread(target=download_segment, args=(segment,), daemon=True) for segment in segments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with lock:
+            save_parts()
+        if bar:
+            bar.close()
+
+        if errors:
+            raise errors[0]
+
+        if any(segment[0] + segment[2] <= segment[1] for segment in segments):
+            return "incomplete"
+
+        os.remove(parts_file_name)
+        return "completed"
+
+    # Get the data nodes of the site found by the previous runs (see CKDataNodes)
+    def __load_data_nodes(self):
+        return self.__get_cache().get_data_nodes(self.__site, time.time() - CKUtils.DATA_NODE_TTL)
+
+    # Probe a data node : latency and throughput of the first bytes of a file (see CKDataNodes)
+    def __probe_data_node(self, node, path):
+        start_time = time.monotonic()
+        nb_bytes = 0
+
+        try:
+            with self.__request('GET', node + "/data" + path, kind="node_probe", adapt_rate=False, allow_redirects=False, stream=True,
+                                headers={"Range": "bytes=0-" + str(CKDataNodes.PROBE_SIZE - 1)}) as response:
+                latency = time.monotonic() - start_time
+
+                # File not on this node : the node answers all the same
+                if response.status_code == 404:
+                    return latency, None
+                if response.status_code not in (200, 206) or CKRateLimiter.is_throttled(response):
+                    return None
+
+                for data in response.iter_content(chunk_size=65536):
+                    nb_bytes += len(data)
+                    if nb_bytes >= CKDataNodes.PROBE_SIZE:
+                        break
+        except requests.exceptions.RequestException:
+            return None
+        finally:
+            self.__metrics.add_bytes("node_probe", nb_bytes)
+
+        transfer_time = time.monotonic() - start_time - latency
+        return latency, nb_bytes / transfer_time if nb_bytes >= CKDataNodes.PROBE_SIZE and transfer_time > 0 else None
+
+    # Send a request to a data node, the node statistics being updated with the response
+    def __data_node_request(self, node, method, url, kind, **kwargs):
+        start_time = time.monotonic()
+        try:
+            response = self.__request(method, url, kind=kind, adapt_rate=False, allow_redirects=False, **kwargs)
+        except requests.exceptions.RequestException:
+            self.__data_nodes.node_failed(node)
+            raise
+
+        if response.status_code in (200, 206) and not CKRateLimiter.is_throttled(response):
+            self.__data_nodes.response_received(node, time.monotonic() - start_time)
+        # File not on this node : not a failure of the node
+        elif response.status_code != 404:
+            self.__data_nodes.node_failed(node)
+        return response
+
+    # Send the HEAD request of a data file : to the fastest data node, to the next ones if it fails, then to the site (its redirect being followed
+    # and its node recorded)
+    # Arguments :
+    # - path : /data path of the file
+    # - full_path : URL of the file on the site
+    # - kind : request kind in the metrics
+    # - tried_nodes : nodes not to use, the nodes tried are added (set)
+    #
+    # Returns (response, URL of the file, data node of the URL : None if the site answers without redirect)
+    def __head_data_file(self, path, full_path, kind, tried_nodes=None):
+        # No node selection : the site redirects every request
+        if not self.__data_nodes:
+            return self.__request('HEAD', full_path, kind=kind), full_path, None
 
-        for nb_files in nb_files_per_type:
-            print("Nb " + nb_files + "(s) : " + str(nb_files_per_type[nb_files]))
+        tried_nodes = set() if tried_nodes is None else tried_nodes
 
-        for file in file_list:
-            # directory_name = file["published"] + "-" + file["post_title"]
-            directory_name = requests.utils.unquote(user_name) + "/" + file["post_title"]
-            os.makedirs(directory_name, exist_ok = True)
-            file_name = directory_name + "/" + file["name"]
-            published = datetime.strptime(file["published"], '%Y-%m-%dT%H:%M:%S')
-            
-            if not overwrite_file and os.path.isfile(file_name):
+        while True:
+            node = self.__data_nodes.get_best_node(path, tried_nodes)
+            if node is None:
+                break
+
+            tried_nodes.add(node)
+            url = node + "/data" + path
+            try:
+                response = self.__data_node_request(node, 'HEAD', url, kind)
+            except requests.exceptions.RequestException:
+                continue
+
+            if response.status_code == 200 and not CKRateLimiter.is_throttled(response):
+                return response, url, node
+
+        response = self.__request('HEAD', full_path, kind=kind, allow_redirects=False)
+        if not response.is_redirect:
+            return response, full_path, None
+
+        url = urllib.parse.urljoin(full_path, response.headers["Location"])
+        node = CKDataNodes.get_url_node(url)
+        if node is None:
+            return self.__request('HEAD', url, kind=kind), url, None
+
+        # Node kept for the next runs
+        if self.__data_nodes.add_node(node):
+            self.__get_cache().add_data_node(self.__site, node)
+        tried_nodes.add(node)
+
+        # Error of the node the site redirected to : the other nodes are tried if any is left
+        try:
+            response = self.__data_node_request(node, 'HEAD', url, kind)
+        except requests.exceptions.RequestException:
+            if self.__data_nodes.get_best_node(path, tried_nodes) is None:
+                raise
+            return self.__head_data_file(path, full_path, kind, tried_nodes)
+
+        if response.status_code not in (200, 404) and self.__data_nodes.get_best_node(path, tried_nodes) is not None:
+            return self.__head_data_file(path, full_path, kind, tried_nodes)
+
+        return response, url, node
+
+    # Transfer from a data node (no effect if node is None) : transfers in progress and throughput of the node
+    # Arguments :
+    # - received : [number of bytes received for the file], incremented by the transfer
+    @contextlib.contextmanager
+    def __data_node_transfer(self, node, received):
+        if node is None:
+            yield
+            return
+
+        nb_bytes = received[0]
+        start_time = time.monotonic()
+        self.__data_nodes.transfer_started(node)
+        try:
+            yield
+        finally:
+            self.__data_nodes.transfer_done(node, received[0] - nb_bytes, time.monotonic() - start_time)
+
+    # Send the GET request of a data file (see __head_data_file), to its data node or to the site if node is None
+    def __get_data_file(self, node, url, kind, **kwargs):
+        if node is None:
+            return self.__request('GET', url, kind=kind, **kwargs)
+        return self.__data_node_request(node, 'GET', url, kind, **kwargs)
+
+    # Get the download location of a file
+    # Returns (directory name, file name)
+    def __get_download_file_name(self, user_name, file):
+        # directory_name = file["published"] + "-" + file["post_title"]
+        directory_name = requests.utils.unquote(user_name) + "/" + file["post_title"]
+        return directory_name, directory_name + "/" + file["name"]
+
+    # Get the download slot of an URL's host (limits the number of parallel downloads per host)
+    def __get_host_slot(self, url):
+        host = urllib.parse.urlparse(url).netloc
+
+        with self.__host_slots_lock:
+            if host not in self.__host_slots:
+                if self.__max_per_host:
+                    self.__host_slots[host] = threading.BoundedSemaphore(self.__max_per_host)
+                else:
+                    self.__host_slots[host] = contextlib.nullcontext()
+            return self.__host_slots[host]
+
+    # Download one file.
+    # Arguments :
+    # - user_name : user name (download directory)
+    # - file : file to download (see __get_user_files)
+    # - overwrite_file : if false, do not download if file already exists.
+    # - progress : CKProgress shared by parallel downloads (one progress bar per file if omitted)
+    # - stats : CKDownloadStats of the user
+    # - journal : CKJournal of the user (None if disabled)
+    #
+    # Returns download status : "downloaded", "linked" (from the content-addressed store), "skipped", "ignored", "throttled" (to download later) or "failed"
+    def __download_file(self, user_name, file, overwrite_file=False, quiet=False, progress=None, stats=None, journal=None):
+        display = progress.write if progress else print
+
+        directory_name, file_name = self.__get_download_file_name(user_name, file)
+
+        # Completed by a previous run : the file is not checked on disk
+        if journal and not overwrite_file and not self.__recheck and journal.is_completed(file_name):
+            if not quiet:
+                display("Download skipped, file completed by a previous run :'" + file_name + "'")
+            return "skipped"
+
+        dir_index = self.__get_dir_index(user_name)
+        dir_index.makedirs(directory_name)
+        published = datetime.fromisoformat(file["published"]).timestamp()
+        
+        # Same destination in two posts (same title and file name, other content) : the second file is skipped once the first one is written
+        with self.__lock_file(file_name):
+            if not overwrite_file and dir_index.is_file(file_name):
                 if not quiet:
-                   print("Download skipped, file already exists :'" + file_name + "'")
+                   display("Download skipped, file already exists :'" + file_name + "'")
                 # Set file modification time to the publication date
-                os.utime(file_name, (published.timestamp(), published.timestamp()))
-                os.utime(directory_name, (published.timestamp(), published.timestamp()))
+                dir_index.set_file_time(file_name, published)
+                dir_index.set_directory_time(directory_name, published)
+                return "skipped"
 
-            elif os.path.isfile(file_name + ".ignore"):
+            if dir_index.is_file(file_name + ".ignore"):
                 if not quiet:
-                    print("Download skipped, file ignored :'" + file_name + "'")
-                os.utime(directory_name, (published.timestamp(), published.timestamp()))
+                    display("Download skipped, file ignored :'" + file_name + "'")
+                dir_index.set_directory_time(directory_name, published)
+                return "ignored"
+
+            if self.__store_dir:
+                status = self.__download_to_store(file, file_name, quiet, display, progress, stats, journal)
             else:
-                nb_download_retries = 0
-                download_completed = False
-                file_name_tmp = file_name + ".tmp"
-                
-                while nb_download_retries < 100 and not download_completed:
-                    try:                                            
-                        if os.path.isfile(file_name_tmp):
-                            already_downloaded = os.path.getsize(file_name_tmp)                       
-                            file_access = "ab"
-                            headers = {"Range" : "bytes=" + str(already_downloaded) + "-"}
-                        else:
-                            already_downloaded = 0
-                            file_access = "wb"
-                            headers = {}
+                status = self.__transfer_file(file, file_name, quiet, display, progress, stats, journal, file_name, dir_index)
 
-                        try:
-                            response = requests.request('HEAD', file["full_path"])
+            if status not in ("downloaded", "linked"):
+                return status
 
-                            server = response.headers.get('Server')
+            # Set file modification time to the publication date
+            dir_index.file_written(file_name)
+            dir_index.set_file_time(file_name, published)
+            dir_index.set_directory_time(directory_name, published)
+            return status
 
-                            if server == 'ddos-guard':
-                                print("DDOS detection, skip file '" + file_name + "'")
-                                nb_download_retries=100
-                                continue
+    # Get the directory index of a user (see CKDirectoryIndex), kept until the end of the downloads
+    def __get_dir_index(self, user_name):
+        root = requests.utils.unquote(user_name)
 
-                            if response.status_code != 200:
-                                print("HTTP error " + str(response.status_code) + ", skip file '" + file_name + "'")
-                                nb_download_retries=100
+        with self.__dir_indexes_lock:
+            if root not in self.__dir_indexes:
+                self.__dir_indexes[root] = CKDirectoryIndex(root, scan=self.__dir_index)
+            return self.__dir_indexes[root]
+
+    # Set the modification times of the directories and forget the directory indexes (end of the downloads, also on an error or Ctrl-C)
+    def __close_dir_indexes(self):
+        with self.__dir_indexes_lock:
+            dir_indexes = list(self.__dir_indexes.values())
+            self.__dir_indexes.clear()
+
+        for dir_index in dir_indexes:
+            dir_index.flush()
+
+    # Download the data of a file, resuming the .tmp file of a previous try
+    # Arguments :
+    # - file : file to download (see __get_user_files)
+    # - file_name : downloaded file name (the data is written in file_name + ".tmp")
+    # - display : function displaying a message
+    # - journal_name : name of the file in the journal (the file name in the user directory)
+    # - dir_index : CKDirectoryIndex of the user directory (.tmp file checked on disk if omitted)
+    # - other arguments : see __download_file
+    #
+    # Returns download status : "downloaded", "throttled" or "failed"
+    def __transfer_file(self, file, file_name, quiet, display, progress, stats, journal, journal_name, dir_index=None):
+        nb_download_retries = 0
+        download_completed = False
+        file_name_tmp = file_name + ".tmp"
+        # Bytes received, for the file throughput
+        received = [0]
+        expected_hash = CKUtils.__get_expected_hash(file) if self.__verify else None
+        # Data nodes already tried for the file (see __head_data_file)
+        tried_nodes = set()
+        
+        with self.__metrics.phase("download"):
+            transfer_start_time = time.monotonic()
+
+            while nb_download_retries < CKUtils.MAX_DOWNLOAD_RETRIES and not download_completed:
+                node = None
+                try:                                            
+                    # .tmp file of a previous run found in the index, the tries of this run are checked on disk
+                    tmp_file = dir_index.get_file(file_name_tmp) if dir_index else CKDirectoryIndex.stat_file(file_name_tmp)
+                    if dir_index:
+                        dir_index.file_written(file_name_tmp)
+
+                    if tmp_file:
+                        already_downloaded = tmp_file[0]
+                        file_access = "ab"
+                        headers = {"Range" : "bytes=" + str(already_downloaded) + "-"}
+                    else:
+                        already_downloaded = 0
+                        file_access = "wb"
+                        headers = {}
+
+                    if journal:
+                        journal.file_in_progress(journal_name, already_downloaded, file_name_tmp)
+
+                    response, url, node = self.__head_data_file(file["path"], file["full_path"], "file_head", tried_nodes)
+
+                    # Error of the data node the site redirects to : the file is requested from another node if any, later otherwise
+                    if node and response.status_code not in (200, 404):
+                        if self.__data_nodes.get_best_node(file["path"], tried_nodes):
+                            raise CKDataNodeError("HTTP error " + str(response.status_code) + " from data node " + node)
+                        if not quiet:
+                            display("Data node error (HTTP " + str(response.status_code) + "), download file later '" + file_name + "'")
+                        return "throttled"
+
+                    # Throttled : the file is downloaded later, when the site accepts requests again
+                    if CKRateLimiter.is_throttled(response):
+                        if not quiet:
+                            display("Throttled (HTTP " + str(response.status_code) + "), download file later '" + file_name + "'")
+                        return "throttled"
+
+                    if response.status_code != 200:
+                        display("HTTP error " + str(response.status_code) + ", skip file '" + file_name + "'")
+                        return "failed"
+
+                    # Parallel downloads limited per host : the data node (or the site) actually requested
+                    with self.__get_host_slot(url):
+                        total_size = int(response.headers.get('content-length', 0))
+
+                        # Large file : byte ranges downloaded in parallel (not for a .tmp file started with one stream)
+                        if self.__segments > 1 and total_size >= self.__segment_threshold and (already_downloaded == 0 or os.path.isfile(file_name_tmp + ".parts")):
+                            # Error of the data node : the file is requested from another node if any, later otherwise
+                            try:
+                                with self.__data_node_transfer(node, received):
+                                    segments_status = self.__download_segments(node, url, file_name, total_size, progress, stats, received)
+                            except CKDataNodeError:
+                                if self.__data_nodes.get_best_node(file["path"], tried_nodes):
+                                    raise
+                                if not quiet:
+                                    display("Data node error, download file later '" + file_name + "'")
+                                return "throttled"
+
+                            if segments_status == "completed":
+                                # Segments written in any order : the file is hashed once completed
+                                if expected_hash:
+                                    self.__check_file_hash(CKUtils.__hash_file(file_name_tmp), expected_hash, file_name_tmp)
+                                download_completed = True
+                                os.rename(file_name_tmp, file_name)
                                 continue
 
-                            total_size = int(response.headers.get('content-length', 0))
-
-                        except (requests.exceptions.ConnectionError) as e:
-                            print("Connection error, skip file '" + file_name + "'")
-                            nb_download_retries=100
-                            continue
-                        
-
-
-                        with requests.get(file["full_path"], stream=True, headers=headers) as response:
-                           with open(file_name_tmp, file_access) as file_object, tqdm(
-                               desc=file_name,
-                               total=total_size,
-                               unit='B',
-                               unit_scale=True,
-                               unit_divisor=1024,
-                               initial=already_downloaded
-                           ) as bar:
-                               for data in response.iter_content(chunk_size=1024):
-                                  size = file_object.write(data)
-                                  bar.update(size)
-                        
+                            if segments_status == "incomplete":
+                                raise requests.exceptions.ChunkedEncodingError("Not Fully downloaded!")
+
+                            if segments_status == "throttled":
+                                return "throttled"
+
+                            # Byte ranges ignored by the server : one stream from the start
+                            display("Byte ranges not supported, download file '" + file_name + "' with one stream")
+                            already_downloaded = 0
+                            file_access = "wb"
+                            headers = {}
+
+                        with self.__get_data_file(node, url, "file_get", stream=True, headers=headers) as response, self.__data_node_transfer(node, received):
+                            # Error of a data node : the file is requested from another node if any
+                            if node and (response.status_code not in (200, 206) or CKRateLimiter.is_throttled(response)) and \
+                               self.__data_nodes.get_best_node(file["path"], tried_nodes):
+                                raise CKDataNodeError("HTTP error " + str(response.status_code) + " from data node " + node)
+
+                            if CKRateLimiter.is_throttled(response):
+                                if not quiet:
+                                    display("Throttled (HTTP " + str(response.status_code) + "), download file later '" + file_name + "'")
+                                return "throttled"
+
+                            if response.status_code not in (200, 206):
+                                display("HTTP error " + str(response.status_code) + ", skip file '" + file_name + "'")
+                                return "failed"
+
+                            # Range ignored by the server : download from the start
+                            if response.status_code == 200 and already_downloaded > 0:
+                                already_downloaded = 0
+                                file_access = "wb"
+
+                            # Content hashed while written, from the bytes of a previous try if resumed
+                            hasher = None
+                            if expected_hash:
+                                hasher = CKUtils.__hash_file(file_name_tmp) if already_downloaded > 0 else hashlib.sha256()
+
+                            nb_bytes = 0
+                            disk_write_time = 0
+                            try:
+                                if progress:
+                                    progress.add_size(total_size, already_downloaded)
+                                    with open(file_name_tmp, file_access) as file_object:
+                                        for data in response.iter_content(chunk_size=1024):
+                                            write_time = time.perf_counter()
+                                            size = file_object.write(data)
+                                            disk_write_time += time.perf_counter() - write_time
+                                            nb_bytes += size
+                                            if hasher:
+                                                hasher.update(data)
+                                            progress.update(size)
+                                            self.__bandwidth_limiter.consume(size)
+                                            if stats:
+                                                stats.add_bytes(size)
+                                else:
+                                   with open(file_name_tmp, file_access) as file_object, tqdm(
+                                       desc=file_name,
+                                       total=total_size,
+                                       unit='B',
+                                       unit_scale=True,
+                                       unit_divisor=1024,
+                                       initial=already_downloaded
+                                   ) as bar:
+                                       for data in response.iter_content(chunk_size=1024):
+                                          write_time = time.perf_counter()
+                                          size = file_object.write(data)
+                                          disk_write_time += time.perf_counter() - write_time
+                                          nb_bytes += size
+                                          if hasher:
+                                              hasher.update(data)
+                                          bar.update(size)
+                                          self.__bandwidth_limiter.consume(size)
+                                          if stats:
+                                              stats.add_bytes(size)
+                            finally:
+                                received[0] += nb_bytes
+                                self.__metrics.add_bytes("file_get", nb_bytes)
+                                self.__metrics.add_disk_write_time(disk_write_time)
+                    
                         already_downloaded = os.path.getsize(file_name_tmp)
                         if already_downloaded < total_size:
-                           print("Not Fully downloaded!")
-                           #sys.exit(3)
-                           nb_download_retries=100
-                           continue
+                           raise requests.exceptions.ChunkedEncodingError("Not Fully downloaded!")
                         else:   
+                           if hasher:
+                               self.__check_file_hash(hasher, expected_hash, file_name_tmp)
                            download_completed = True
                            os.rename(file_name_tmp, file_name)      
-                        
-                    except (requests.exceptions.RequestException) as e:
-                        print("Time Out! (" + type(e).__name__ + ")")
-                        #print("Time Out!")
-                        sys.exit(4)
-                             
-                        if nb_download_retries != 100:
-                           nb_download_retries += 1
-                           print("Try again from bytes already downloaded : " + str(nb_download_retries)) 
-                               
-
-
-                if download_completed:
-                    # Set file modification time to the publication date
-                    os.utime(file_name, (published.timestamp(), published.timestamp()))
-                    os.utime(directory_name, (published.timestamp(), published.timestamp()))
+                    
+                except (requests.exceptions.RequestException, CKHashMismatchError, CKDataNodeError) as e:
+                    # Connection errors, time outs, truncated transfers : try again later from bytes already downloaded
+                    # (from the start if the content does not match its hash)
+                    nb_download_retries += 1
+                    display("Download error (" + type(e).__name__ + "), file '" + file_name + "'")
+
+                    if journal:
+                        journal.file_in_progress(journal_name, os.path.getsize(file_name_tmp) if os.path.isfile(file_name_tmp) else 0, file_name_tmp)
+
+                    # Error of a data node : put aside, the next try goes to another node without waiting
+                    failover = False
+                    if node:
+                        if not isinstance(e, (CKDataNodeError, CKHashMismatchError)):
+                            self.__data_nodes.node_failed(node)
+                        failover = self.__data_nodes.get_best_node(file["path"], tried_nodes) is not None
+
+                    if nb_download_retries < CKUtils.MAX_DOWNLOAD_RETRIES:
+                       self.__metrics.retry("hash_mismatch" if isinstance(e, CKHashMismatchError) else "data_node" if failover else "download")
+                       display("Try again from bytes already downloaded : " + str(nb_download_retries)) 
+                       if not failover:
+                           time.sleep(min(2 ** nb_download_retries, 60))
+
+        if not download_completed:
+            return "failed"
+
+        self.__metrics.file_transferred(received[0], time.monotonic() - transfer_start_time)
+        return "downloaded"
+
+    # Get the content hash of a file from its /data path (None if the path is not a SHA-256 hash)
+    @staticmethod
+    def __get_expected_hash(file):
+        file_hash = os.path.splitext(os.path.basename(file["path"]))[0].lower()
+        return file_hash if re.fullmatch(r'[0-9a-f]{64}', file_hash) else None
+
+    # Check the hash of a downloaded file, the file is removed if it does not match (downloaded again from the start)
+    # Arguments :
+    # - hasher : SHA-256 of the downloaded content
+    # - expected_hash : content hash of the /data path
+    # - file_name_tmp : downloaded file
+    def __check_file_hash(self, hasher, expected_hash, file_name_tmp):
+        if hasher.hexdigest() == expected_hash:
+            return
+
+        os.remove(file_name_tmp)
+        if os.path.isfile(file_name_tmp + ".parts"):
+            os.remove(file_name_tmp + ".parts")
+        raise CKHashMismatchError("Hash mismatch : " + hasher.hexdigest() + " instead of " + expected_hash)
+
+    # Hash a file with memory-mapped reads
+    # Returns SHA-256 object of the content
+    @staticmethod
+    def __hash_file(file_name):
+        hasher = hashlib.sha256()
+
+        with open(file_name, "rb") as file_object:
+            # Empty files cannot be mapped
+            if os.fstat(file_object.fileno()).st_size > 0:
+                with mmap.mmap(file_object.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                    hasher.update(mapped_file)
+
+        return hasher
+
+    # Get the SHA-256 hash of a file (None if the file cannot be read), function run by the processes of verify_user_files
+    @staticmethod
+    def get_file_hash(file_name):
+        try:
+            return CKUtils.__hash_file(file_name).hexdigest()
+        except OSError:
+            return None
+
+    # Download a file into the content-addressed store, once for all the posts and users, and link it into the post directory
+    # Arguments : see __transfer_file
+    #
+    # Returns download status : "downloaded", "linked" (already in the store), "throttled" or "failed"
+    def __download_to_store(self, file, file_name, quiet, display, progress, stats, journal):
+        # Same layout as the site : the file name is the content hash
+        store_name = os.path.basename(file["path"])
+        store_file_name = os.path.join(self.__store_dir, store_name[0:2], store_name[2:4], store_name)
+
+        with self.__lock_file(store_file_name):
+            if os.path.isfile(store_file_name):
+                status = "linked"
+                if not quiet:
+                    display("File linked from the store :'" + file_name + "'")
+                if stats:
+                    stats.file_linked(os.path.getsize(store_file_name))
+            else:
+                os.makedirs(os.path.dirname(store_file_name), exist_ok=True)
+                status = self.__transfer_file(file, store_file_name, quiet, display, progress, stats, journal, file_name)
+                if status != "downloaded":
+                    return status
+
+            CKUtils.__link_file(store_file_name, file_name)
+
+        return status
+
+    # Lock a file written by the downloads (file of the store or downloaded file) : one parallel download at a time writes it
+    @contextlib.contextmanager
+    def __lock_file(self, file_name):
+        with self.__file_locks_lock:
+            file_lock = self.__file_locks.setdefault(file_name, [threading.Lock(), 0])
+            file_lock[1] += 1
+        try:
+            with file_lock[0]:
+                yield
+        finally:
+            with self.__file_locks_lock:
+                file_lock[1] -= 1
+                if file_lock[1] == 0:
+                    del self.__file_locks[file_name]
+
+    # Link a file : hard link, reflink if hard links are not possible (store on another file system...), copy otherwise.
+    # The file is replaced at once if it exists.
+    @staticmethod
+    def __link_file(source_file_name, file_name):
+        # Already linked (a rename between two links of the same file does nothing)
+        if os.path.isfile(file_name) and os.path.samefile(source_file_name, file_name):
+            return
+
+        file_name_link = file_name + ".link"
+        if os.path.lexists(file_name_link):
+            os.remove(file_name_link)
+
+        try:
+            os.link(source_file_name, file_name_link)
+        except OSError:
+            try:
+                import fcntl
+                with open(source_file_name, "rb") as source_file, open(file_name_link, "wb") as file_object:
+                    # FICLONE : the copy shares the blocks of the source (Btrfs, XFS...)
+                    fcntl.ioctl(file_object.fileno(), 0x40049409, source_file.fileno())
+            except (ImportError, OSError):
+                shutil.copyfile(source_file_name, file_name_link)
+
+        os.replace(file_name_link, file_name)
                                 
     # Display user collabs.
     # Arguments :
     # - user_id : user ID
-    def display_user_collabs(self, user_id):
-        
+    # - jobs : number of parallel user checks
+    # - depth : crawl the collaboration graph up to depth users away and display its edges (0 : display user's collabs)
+    # - max_users : max number of users whose posts are read by the crawl
+    # - timeout : max duration of the crawl, in seconds
+    # - output : CKOutput of the collabs or of the edges (CKOutput.COLLAB_FIELDS), written page after page, "collab : URL" lines sorted at the
+    #   end if omitted
+    def display_user_collabs(self, user_id, jobs=8, depth=0, max_users=100, timeout=600, output=None):
+        if depth > 0:
+            self.__crawl_user_collabs(user_id, jobs, depth, max_users, timeout, output)
+            return
+
+        if output:
+            self.__output_user_collabs(user_id, jobs, output)
+            return
+
+        collabs = sorted(self.__get_user_collabs(user_id))
+        users_exist = self.__check_users_exist(collabs, jobs)
+
+        for collab in collabs:
+            # Check if collab is reachable
+            if users_exist[collab]:
+                result = self.__site_url + '/' + self.__service + '/user/' + collab
+            else:
+                result = ''
+            
+            print(collab + " : " + result)
+
+    # Write user's collabs page after page : the collabs found in a page of posts are checked and written before the next page is read
+    # Arguments : see display_user_collabs
+    def __output_user_collabs(self, user_id, jobs, output):
+        posts = self.__get_user_posts(user_id)
+        collabs = set()
+
+        while True:
+            page_posts = list(itertools.islice(posts, 50))
+            if len(page_posts) == 0:
+                return
+
+            page_collabs = sorted(self.__get_posts_collabs(page_posts) - collabs)
+            collabs.update(page_collabs)
+            users_exist = self.__check_users_exist(page_collabs, jobs)
+
+            for collab in page_collabs:
+                url = self.__site_url + '/' + self.__service + '/user/' + collab if users_exist[collab] else None
+                output.write(CKOutput.COLLAB_FIELDS, (user_id, collab, users_exist[collab], url))
+
+    # Crawl the collaboration graph breadth-first and display its edges : "user -> collab : URL"
+    # Arguments : see display_user_collabs
+    #
+    # Posts are read from the local index, synchronized if older than the collab TTL.
+    def __crawl_user_collabs(self, user_id, jobs, depth, max_users, timeout, output=None):
+        end_time = time.monotonic() + timeout
+        visited_users = {user_id}
+        users = [user_id]
+        nb_users = 0
+
+        for level in range(depth):
+            next_users = []
+
+            for user in users:
+                if nb_users >= max_users or time.monotonic() > end_time:
+                    print("Crawl stopped after " + str(nb_users) + " users", file=sys.stderr if output else sys.stdout)
+                    return
+                nb_users += 1
+
+                collabs = sorted(self.__get_user_collabs(user, self.__collab_ttl))
+                users_exist = self.__check_users_exist(collabs, jobs)
+
+                for collab in collabs:
+                    if not users_exist[collab] or collab == user:
+                        continue
+
+                    url = self.__site_url + '/' + self.__service + '/user/' + collab
+                    if output:
+                        output.write(CKOutput.COLLAB_FIELDS, (user, collab, True, url))
+                    else:
+                        print(user + " -> " + collab + " : " + url)
+
+                    if collab not in visited_users:
+                        visited_users.add(collab)
+                        next_users.append(collab)
+
+            users = next_users
+
+    # Get user's collabs : users mentioned in the posts
+    # Arguments :
+    # - user_id : user ID
+    # - max_age : read the posts from the local index, synchronized if older than max_age seconds (see CKUtils max_age if omitted)
+    #
+    # Returns set of user IDs
+    def __get_user_collabs(self, user_id, max_age=None):
+        if max_age is not None and not self.__offline:
+            posts = self.__get_indexed_post_pages(user_id, max_age)
+            posts = itertools.chain.from_iterable(posts)
+        else:
+            posts = self.__get_user_posts(user_id)
+
+        return self.__get_posts_collabs(posts)
+
+    # Get the users mentioned in posts
+    # Arguments :
+    # - posts : iterable of posts
+    #
+    # Returns set of user IDs
+    def __get_posts_collabs(self, posts):
+        collabs = set()
+
         # Loop all the posts
-        post_list = self.__get_user_posts(user_id)
-        
-        collabs = []
-        for post in post_list:
-            post_content = post["content"]
+        for post in posts:
+            post_content = post["content"] or ""
 
-            post_collabs = re.findall(r'@[a-zA-Z0-9_\-\.]*', post_content) + \
-                           re.findall(r'https://onlyfans.com/[/a-zA-Z0-9_\-\.]*', post_content)
+            post_collabs = re.findall(r'@([a-zA-Z0-9_\-\.]*)', post_content) + \
+                           re.findall(r'https://onlyfans.com/([a-zA-Z0-9_\-\.]*)', post_content)
 
             for collab in post_collabs:
                 collab = collab.lower()
                 # suppress last character if it's a special one
-                if collab[-1] in ['.', '-']:
+                if collab and collab[-1] in ['.', '-']:
                     collab = collab[:-1]
-                collabs.append(collab)
+                if collab:
+                    collabs.add(collab)
 
-        for collab in sorted(set(collabs)):
-            collab = collab[1:]
+        return collabs
 
-            # Check if collab is reachable
-            if self.__check_user_exists(collab):
-                result = 'https://' + self.__site + '/' + self.__service + '/user/' + collab
-            else:
-                result = ''
-            
-            print(collab + " : " + result)
-             
+    # Check users, the results being cached for the collab TTL
+    # Arguments :
+    # - users : user IDs
+    # - jobs : number of parallel checks
+    #
+    # Returns {user: bool}
+    def __check_users_exist(self, users, jobs=8):
+        cache = self.__get_cache()
+        users_exist = cache.get_users_exist(self.__site, self.__service, users, time.time() - self.__collab_ttl)
+        unknown_users = [user for user in users if user not in users_exist]
+
+        checked_users = {}
+
+        with self.__metrics.phase("user_checks"), concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for user, user_exists in zip(unknown_users, executor.map(self.__check_user_exists, unknown_users)):
+                # Unknown result (None) is not cached
+                if user_exists is not None:
+                    checked_users[user] = user_exists
+                users_exist[user] = bool(user_exists)
+
+        cache.set_users_exist(self.__site, self.__service, checked_users)
+
+        return users_exist
 
 
     # Display user links found in posts.
     # Arguments :
     # - user_id : user ID
-    def display_user_links(self, user_id):
+    # - output : CKOutput of the links (CKOutput.LINK_FIELDS, first post of every link) written as the posts are read, links sorted at the end
+    #   if omitted
+    def display_user_links(self, user_id, output=None):
         
+        links = set()
+
         # Loop all the posts
-        post_list = self.__get_user_posts(user_id)
-        
-        links = []
-        for post in post_list:
+        for post in self.__get_user_posts(user_id):
             post_content = post["content"]
             post_links = re.findall(r'https://[^ <"]*', post_content)
             for link in post_links:
-                links.append(link)
+                if output and link not in links:
+                    output.write(CKOutput.LINK_FIELDS, (user_id, post["id"], post["published"], link))
+                links.add(link)
+
+        if output:
+            return
 
-        for link in sorted(set(links)):
+        for link in sorted(links):
             print(link)
 
 # Catch Ctrl-C
 def signal_handler(signum, frame):
+    # The journals keep track of the downloads in progress
+    CKJournal.flush_all()
     print("Program stopped")
     sys.exit(100)
-    
-signal.signal(signal.SIGINT, signal_handler)
+
+# Read a batch file, one user per line :
+# - "user_id" or "service user_id"
+# - or a JSON object {"service": "string", "user_id": "string", "file_type": "string", "from_date": "YYYY/MM/DD hh:mm:ss", "to_date": ..., "from_post_id": ...,
+#   "to_post_id": ..., "reverse_order": bool, "priority": int (download order "creator")}
+# Empty lines and lines starting with # are ignored. Filters default to the command arguments.
+#
+# Returns list of entries (see CKUtils.download_users_files)
+def read_batch_file(file_name, args):
+    entries = []
+
+    with open(file_name) as batch_file:
+        for line in batch_file:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+
+            entry = {"service": args.service, "file_type": args.file_type, "from_date": args.from_date, "to_date": args.to_date,
+                     "from_post_id": args.from_post_id, "to_post_id": args.to_post_id, "reverse_order": args.reverse_order}
+
+            if line.startswith("{"):
+                line_entry = json.loads(line)
+                if "file_type" in line_entry:
+                    line_entry["file_type"] = CKUtils.File_type.from_str(line_entry["file_type"])
+                for date in ("from_date", "to_date"):
+                    if line_entry.get(date):
+                        line_entry[date] = datetime.strptime(line_entry[date], '%Y/%m/%d %H:%M:%S')
+                entry.update(line_entry)
+            else:
+                fields = line.split()
+                if len(fields) > 1:
+                    entry["service"] = fields[0]
+                entry["user_id"] = fields[-1]
+
+            entries.append(entry)
+
+    return entries
+
+# Parse the download order of the command arguments ("type,smallest"...)
+def parse_download_order(value):
+    order = value.split(',')
+    for download_order in order:
+        if download_order not in CKUtils.DOWNLOAD_ORDERS:
+            raise argparse.ArgumentTypeError("invalid order '" + download_order + "' (choose from " + ", ".join(CKUtils.DOWNLOAD_ORDERS) + ")")
+    return order
 
 # Command arguments : 
 # - -w/--web_site : web site, required
-# - -u/--user-id : user ID, required OR -f/--favorites : favorite posts
+# - -u/--user-id : user ID, required OR -f/--favorites : favorite posts OR -b/--batch : batch file of users (see read_batch_file)
 # - -s/--service : service (default onlyfans)
-# - -a/--action (download-files, list-files, list-collabs
+# - -a/--action (download-files, list-files, list-collabs, list-links, verify : hash the downloaded files again and report the corrupt ones
 # 
 #   For list and download files only
 # - -ft/--file-type : file type (video, image, archive, other)
@@ -479,58 +3298,200 @@ signal.signal(signal.SIGINT, signal_handler)
 # - -fpi/--from-post-id : parse posts added after this date
 # - -tpi/--to-post-id : parse posts added before this date
 # - -owf/--overwrite-file : overwrite existing files during download
-# - -sfs/--show-file-size : show file size when executing command list-files (very slow)
+# - -sfs/--show-file-size : show file size when executing command list-files (slow the first time, sizes are cached)
 # - -ro/--reverse-order : list/download from the oldest file (default is latest file)
-
-parser = argparse.ArgumentParser(description="Tool")
-parser.add_argument("-w", "--web-site", required=True, help="Web site : coomer.su or kemono.su")
-
-source_group = parser.add_mutually_exclusive_group(required=True)
-source_group.add_argument("-u", "--user-id", help="service user ID")
-source_group.add_argument("-f", "--favorites", help='favorite posts', action='store_true')
-
-parser.add_argument("-c", "--credentials", default=None, type=lambda c: c.split(':'), help="Site credentials format : username:password")
-
-parser.add_argument("-s", "--service", default="onlyfans", help="Default : onlyfans")
-parser.add_argument("-a", "--action", required=True, choices=['download-files', 'list-files', 'list-collabs', 'list-links'])
-parser.add_argument("-ft", "--file-type", choices=list(CKUtils.File_type), type=CKUtils.File_type.from_str)
-parser.add_argument("-fd", "--from-date", type=lambda d: datetime.strptime(d, '%Y/%m/%d %H:%M:%S'), help="Date format : 'YYYY/MM/DD hh:mm:ss'")
-parser.add_argument("-td", "--to-date", type=lambda d: datetime.strptime(d, '%Y/%m/%d %H:%M:%S'), help="Date format : 'YYYY/MM/DD hh:mm:ss'")
-parser.add_argument("-fpi", "--from-post-id")
-parser.add_argument("-tpi", "--to-post-id")
-parser.add_argument("-q", "--quiet", action='store_true', help='Do not display informative messages like "already downloaded"')
-parser.add_argument("-owf", "--overwrite-file", action='store_true', help='Overwrite existing files during download')
-parser.add_argument("-sfs", "--show-file-size", action='store_true', help='Show file size when executing command list-files (very slow)')
-parser.add_argument("-ro", "--reverse-order", action='store_true', help='List/download from the oldest file (default is latest file)')
-
-args = parser.parse_args()
-
-username = ""
-password = ""
-
-if args.favorites:
-    args.user_id = CKUtils.FAVORITES
-    
-    if args.credentials and len(args.credentials) == 2:
-        username = args.credentials[0]
-        password = args.credentials[1]
-
-    if not username or not password:
-        username = input('Enter your user name:')
-        password = getpass.getpass(prompt="Enter your password:")
-    
-ckutils = CKUtils(args.web_site, args.service, username, password)
-    
-if args.action == "list-files":
-    ckutils.display_user_files(user_id=args.user_id, file_type=args.file_type, from_date=args.from_date, to_date=args.to_date,
-                               from_post_id=args.from_post_id, to_post_id=args.to_post_id, display_size=args.show_file_size, reverse_order=args.reverse_order)
-
-elif args.action == "download-files":
-    ckutils.download_user_files(user_id=args.user_id, file_type=args.file_type, from_date=args.from_date, to_date=args.to_date,
-                                from_post_id=args.from_post_id, to_post_id=args.to_post_id, overwrite_file=args.overwrite_file, reverse_order=args.reverse_order, quiet=args.quiet)
-    
-elif args.action == "list-links":
-    ckutils.display_user_links(user_id=args.user_id)
-    
-elif args.action == "list-collabs":
-    ckutils.display_user_collabs(user_id=args.user_id)
+# - -j/--jobs : number of files downloaded in parallel (download-files), of parallel file size requests (list-files) or of hashing processes (verify)
+# - -mph/--max-per-host : max number of parallel downloads from the same host
+# - -ps/--pool-size : max number of kept-alive connections per host
+# - -to/--timeout : request timeout in seconds
+# - -cd/--cache-dir : directory of the persistent cache (file sizes...)
+# - -npf/--no-prefetch : do not fetch the next page of posts in background
+# - -off/--offline : read the posts from the local index only
+# - -ma/--max-age : read the posts from the local index, synchronized first if older than this number of seconds
+# - -mr/--max-rate : max number of requests per second to the site
+# - -seg/--segments : number of byte ranges downloaded in parallel for a large file
+# - -st/--segment-threshold : min size in MiB of a file downloaded by segments
+# - -ct/--collab-ttl : time in hours during which user checks are cached (list-collabs)
+# - -d/--depth : crawl the collaboration graph up to this depth and display its edges (list-collabs)
+# - -cmu/--crawl-max-users : max number of users read by the crawl
+# - -cto/--crawl-timeout : max duration of the crawl in seconds
+# - -nj/--no-journal : do not keep a download journal in the user directories (an interrupted download is resumed by listing the posts again)
+# - -rck/--recheck : check on disk the files completed according to the download journal, and set their modification time
+# - -nv/--no-verify : do not check the content hash of the downloaded files
+# - -cs/--content-store : directory of a content-addressed store : files are downloaded once and hard-linked (or reflinked, or copied) into the post directories
+# - -bw/--max-bandwidth : max download bandwidth in MiB/s, all transfers together
+# - -o/--order : download order of the queue, comma separated : newest, smallest, type (images first, videos last), creator (order of the batch file)
+# - -ndn/--no-data-nodes : do not select the data node of the files, the site redirects every request to a node
+# - -di/--dir-index : scan each user directory once before its downloads, files are checked in this index (fewer disk accesses on incremental runs)
+# - -fmt/--format : output of list-files, list-links and list-collabs : text (default), ndjson, csv or tsv, written as the posts are read
+# - -mj/--metrics-json : write the run metrics (request latencies, bytes, retries, phase times...) to this JSON file
+# - -mp/--metrics-prom : write the run metrics to this Prometheus textfile
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Tool")
+    parser.add_argument("-w", "--web-site", required=True, help="Web site : coomer.su or kemono.su (https), or URL with the scheme (http://localhost:8000)")
+
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("-u", "--user-id", help="service user ID")
+    source_group.add_argument("-f", "--favorites", help='favorite posts', action='store_true')
+    source_group.add_argument("-b", "--batch", help='batch file : one user per line ("user_id", "service user_id" or JSON object with filters)')
+
+    parser.add_argument("-c", "--credentials", default=None, type=lambda c: c.split(':'), help="Site credentials format : username:password")
+
+    parser.add_argument("-s", "--service", default="onlyfans", help="Default : onlyfans")
+    parser.add_argument("-a", "--action", required=True, choices=['download-files', 'list-files', 'list-collabs', 'list-links', 'verify'])
+    parser.add_argument("-ft", "--file-type", choices=list(CKUtils.File_type), type=CKUtils.File_type.from_str)
+    parser.add_argument("-fd", "--from-date", type=lambda d: datetime.strptime(d, '%Y/%m/%d %H:%M:%S'), help="Date format : 'YYYY/MM/DD hh:mm:ss'")
+    parser.add_argument("-td", "--to-date", type=lambda d: datetime.strptime(d, '%Y/%m/%d %H:%M:%S'), help="Date format : 'YYYY/MM/DD hh:mm:ss'")
+    parser.add_argument("-fpi", "--from-post-id")
+    parser.add_argument("-tpi", "--to-post-id")
+    parser.add_argument("-q", "--quiet", action='store_true', help='Do not display informative messages like "already downloaded"')
+    parser.add_argument("-owf", "--overwrite-file", action='store_true', help='Overwrite existing files during download')
+    parser.add_argument("-sfs", "--show-file-size", action='store_true', help='Show file size when executing command list-files (sizes are cached, the first run on a user is slow)')
+    parser.add_argument("-ro", "--reverse-order", action='store_true', help='List/download from the oldest file (default is latest file)')
+    parser.add_argument("-j", "--jobs", default=None, type=int, help='Number of files downloaded in parallel (default : 1), of parallel file size requests for list-files (default : 8) or of hashing processes for verify (default : number of CPUs)')
+    parser.add_argument("-mph", "--max-per-host", default=None, type=int, help='Max number of parallel downloads from the same host (default : no limit)')
+    parser.add_argument("-ps", "--pool-size", default=10, type=int, help='Max number of kept-alive connections per host, at least the number of jobs (default : 10)')
+    parser.add_argument("-to", "--timeout", default=60, type=float, help='Request timeout in seconds (default : 60)')
+    parser.add_argument("-cd", "--cache-dir", default=None, help='Directory of the persistent cache (default : ~/.cache/ckutils)')
+    parser.add_argument("-npf", "--no-prefetch", action='store_true', help='Do not fetch the next page of posts while the current one is processed')
+    index_group = parser.add_mutually_exclusive_group()
+    index_group.add_argument("-off", "--offline", action='store_true', help='Read the posts from the local index only, without any request')
+    index_group.add_argument("-ma", "--max-age", default=None, type=float, help='Read the posts from the local index, synchronized first (new posts only) if older than this number of seconds')
+    parser.add_argument("-mr", "--max-rate", default=None, type=float, help='Max number of requests per second to the site, all users together (default : no limit)')
+    parser.add_argument("-seg", "--segments", default=1, type=int, help='Number of byte ranges downloaded in parallel for a large file (default : 1, one stream)')
+    parser.add_argument("-st", "--segment-threshold", default=100, type=float, help='Min size in MiB of a file downloaded by segments (default : 100)')
+    parser.add_argument("-ct", "--collab-ttl", default=168, type=float, help='Time in hours during which user checks and crawled posts are cached (default : 168)')
+    parser.add_argument("-d", "--depth", default=0, type=int, help='list-collabs : crawl the collaboration graph up to this depth and display its edges (default : 0, no crawl)')
+    parser.add_argument("-cmu", "--crawl-max-users", default=100, type=int, help='Max number of users read by the crawl (default : 100)')
+    parser.add_argument("-cto", "--crawl-timeout", default=600, type=float, help='Max duration of the crawl in seconds (default : 600)')
+    parser.add_argument("-nj", "--no-journal", action='store_true', help='Do not keep a download journal in the user directories (an interrupted download is resumed by listing the posts again)')
+    parser.add_argument("-rck", "--recheck", action='store_true', help='Check on disk the files completed according to the download journal, and set their modification time')
+    parser.add_argument("-nv", "--no-verify", action='store_true', help='Do not check the content hash of the downloaded files (computed while they are written)')
+    parser.add_argument("-cs", "--content-store", default=None, help='Directory of a content-addressed store : every content is downloaded once and hard-linked (reflinked or copied on another file system) into the post directories')
+    parser.add_argument("-bw", "--max-bandwidth", default=None, type=float, help='Max download bandwidth in MiB/s, all transfers together (default : no limit)')
+    parser.add_argument("-o", "--order", default=None, type=parse_download_order,
+                        help='Download order, comma separated : newest, smallest, type (images first, videos last), creator (order of the batch file) (default : listing order)')
+    parser.add_argument("-ndn", "--no-data-nodes", action='store_true', help='Do not request the files from the fastest data node, the site redirecting every request to a node')
+    parser.add_argument("-di", "--dir-index", action='store_true', help='Scan each user directory once before its downloads and check the files in this index instead of on disk one by one')
+    parser.add_argument("-fmt", "--format", default="text", choices=CKOutput.FORMATS, help='Output of list-files, list-links and list-collabs, written as the posts are read (default : text)')
+    parser.add_argument("-mj", "--metrics-json", default=None, help='Write the run metrics (request latencies, bytes, retries, phase times...) to this JSON file')
+    parser.add_argument("-mp", "--metrics-prom", default=None, help='Write the run metrics to this Prometheus textfile (node_exporter textfile collector)')
+
+    return parser.parse_args(argv)
+
+# Command line entry point
+# Arguments :
+# - argv : command arguments (sys.argv if omitted)
+def main(argv=None):
+    args = parse_arguments(argv)
+
+    signal.signal(signal.SIGINT, signal_handler)
+
+    try:
+        run(args)
+    except CKError as e:
+        print(str(e))
+        sys.exit(e.exit_code)
+    except BrokenPipeError:
+        # Output closed by its reader (head...) : the standard output flushed at exit goes nowhere
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+# Run the action of the command arguments
+def run(args):
+    username = ""
+    password = ""
+
+    if args.favorites:
+        args.user_id = CKUtils.FAVORITES
+
+        if args.credentials and len(args.credentials) == 2:
+            username = args.credentials[0]
+            password = args.credentials[1]
+
+        if not username or not password:
+            username = input('Enter your user name:')
+            password = getpass.getpass(prompt="Enter your password:")
+
+    ckutils = CKUtils(args.web_site, args.service, username, password, max_per_host=args.max_per_host,
+                      pool_size=max(args.pool_size, args.jobs or 8), timeout=args.timeout, cache_dir=args.cache_dir,
+                      prefetch=not args.no_prefetch, offline=args.offline, max_age=args.max_age, max_rate=args.max_rate,
+                      segments=args.segments, segment_threshold=int(args.segment_threshold * 1024 * 1024), collab_ttl=args.collab_ttl * 3600,
+                      journal=not args.no_journal, recheck=args.recheck, verify=not args.no_verify, store_dir=args.content_store,
+                      max_bandwidth=args.max_bandwidth * 1024 * 1024 if args.max_bandwidth else None, data_nodes=not args.no_data_nodes,
+                      dir_index=args.dir_index)
+
+    # Number of corrupt files found by the verify action
+    nb_corrupt_files = 0
+
+    # Machine-readable listings (messages on the error output)
+    output = CKOutput(args.format) if args.format != "text" else None
+
+    # Metrics written at the end of the run, even if interrupted
+    try:
+        if args.batch:
+            entries = read_batch_file(args.batch, args)
+
+            if args.action == "download-files":
+                ckutils.download_users_files(entries, overwrite_file=args.overwrite_file, quiet=args.quiet, jobs=args.jobs or 1, order=args.order)
+
+            # Listings : one user after the other
+            for entry in entries:
+                ckutils_service = ckutils.with_service(entry["service"])
+
+                try:
+                    if args.action == "list-files":
+                        ckutils_service.display_user_files(user_id=entry["user_id"], file_type=entry["file_type"], from_date=entry["from_date"], to_date=entry["to_date"],
+                                                           from_post_id=entry["from_post_id"], to_post_id=entry["to_post_id"], display_size=args.show_file_size,
+                                                           reverse_order=entry["reverse_order"], jobs=args.jobs or 8, output=output)
+                    elif args.action == "list-links":
+                        ckutils_service.display_user_links(user_id=entry["user_id"], output=output)
+                    elif args.action == "list-collabs":
+                        ckutils_service.display_user_collabs(user_id=entry["user_id"], jobs=args.jobs or 8, depth=args.depth,
+                                                             max_users=args.crawl_max_users, timeout=args.crawl_timeout, output=output)
+                    elif args.action == "verify":
+                        nb_corrupt_files += ckutils_service.verify_user_files(user_id=entry["user_id"], file_type=entry["file_type"], from_date=entry["from_date"],
+                                                                              to_date=entry["to_date"], from_post_id=entry["from_post_id"],
+                                                                              to_post_id=entry["to_post_id"], jobs=args.jobs)
+                except Exception as e:
+                    print("Listing error, user '" + entry["user_id"] + "' : " + type(e).__name__ + " (" + str(e) + ")", file=sys.stderr if output else sys.stdout)
+
+        elif args.action == "list-files":
+            ckutils.display_user_files(user_id=args.user_id, file_type=args.file_type, from_date=args.from_date, to_date=args.to_date,
+                                       from_post_id=args.from_post_id, to_post_id=args.to_post_id, display_size=args.show_file_size, reverse_order=args.reverse_order,
+                                       jobs=args.jobs or 8, output=output)
+
+        elif args.action == "download-files":
+            ckutils.download_user_files(user_id=args.user_id, file_type=args.file_type, from_date=args.from_date, to_date=args.to_date,
+                                        from_post_id=args.from_post_id, to_post_id=args.to_post_id, overwrite_file=args.overwrite_file, reverse_order=args.reverse_order, quiet=args.quiet,
+                                        jobs=args.jobs or 1, order=args.order)
+
+        elif args.action == "list-links":
+            ckutils.display_user_links(user_id=args.user_id, output=output)
+
+        elif args.action == "list-collabs":
+            ckutils.display_user_collabs(user_id=args.user_id, jobs=args.jobs or 8, depth=args.depth, max_users=args.crawl_max_users, timeout=args.crawl_timeout,
+                                         output=output)
+
+        elif args.action == "verify":
+            nb_corrupt_files = ckutils.verify_user_files(user_id=args.user_id, file_type=args.file_type, from_date=args.from_date, to_date=args.to_date,
+                                                         from_post_id=args.from_post_id, to_post_id=args.to_post_id, jobs=args.jobs)
+
+        if ckutils.get_throttled_time() > 0:
+            print("Time throttled : " + str(round(ckutils.get_throttled_time(), 1)) + "s", file=sys.stderr if output else sys.stdout)
+
+        if nb_corrupt_files > 0:
+            sys.exit(6)
+    finally:
+        if args.metrics_json or args.metrics_prom:
+            metrics = ckutils.get_metrics()
+            if args.metrics_json:
+                metrics.write_json(args.metrics_json)
+            if args.metrics_prom:
+                metrics.write_prometheus(args.metrics_prom, labels={"site": args.web_site, "action": args.action})
+        ckutils.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,476 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Benchmark of ckutils.py against a local stand-in of the site.
+#
+# The mock server serves synthetic creators (posts, profiles, favorites and data files with byte ranges), with a configurable
+# latency and bandwidth. With data nodes, the site redirects every /data request to the node of the file (one more server per node,
+# node i answering i x NODE_LATENCY_STEP slower, a failing node answering 502). Every scenario runs ckutils.py in a subprocess and reports its
+# wall time, the time of its first output line, peak memory, the requests received by the server and the download throughput. Results are
+# saved in JSON to be compared with another run.
+#
+# Usage :
+#   python ckutils_bench.py -c medium -l 0.02 -o bench_results.json
+#   python ckutils_bench.py -c medium -l 0.02 --compare bench_results.json
+#   python ckutils_bench.py -c medium -n 3 --failing-node 0
+#   python ckutils_bench.py -c medium -s download-files -x="-seg 4 -st 1"
+#   python ckutils_bench.py --serve -p 8000     (mock server only, for manual tests)
+
+CKUTILS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ckutils.py")
+
+SERVICE = "onlyfans"
+PAGE_SIZE = 50
+
+# Additional latency of data node i : i x NODE_LATENCY_STEP seconds
+NODE_LATENCY_STEP = 0.01
+
+# Synthetic creators : number of posts, number of files per post, file size, size of 1 video file out of 10 posts
+CREATOR_SIZES = {
+    "small":  {"nb_posts": 50,    "nb_files": 2, "file_size": 16 * 1024, "video_size": 2 * 1024 * 1024},
+    "medium": {"nb_posts": 500,   "nb_files": 2, "file_size": 16 * 1024, "video_size": 4 * 1024 * 1024},
+    "large":  {"nb_posts": 5000,  "nb_files": 2, "file_size": 4 * 1024,  "video_size": 4 * 1024 * 1024},
+    "huge":   {"nb_posts": 50000, "nb_files": 1, "file_size": 512,       "video_size": 0},
+}
+
+SCENARIOS = ["list-files", "list-files-ndjson", "list-files-sfs", "list-files-sfs-cached", "download-files", "download-files-resume", "download-files-incremental", "download-files-store", "list-collabs", "list-collabs-ndjson"]
+
+
+# Synthetic site : creators, posts and data files
+class MockSite:
+    # Constructor
+    # Arguments :
+    # - creator_size : key of CREATOR_SIZES, size of the benchmarked creator ("bench")
+    def __init__(self, creator_size):
+        self.creators = {}
+        self.files = {}
+        self.add_creator("bench", mentions=["collab0", "collab1", "collab2", "nobody"], **CREATOR_SIZES[creator_size])
+
+        # Small creators mentioned in the posts (collabs), reposting the main file of the benchmarked creator's posts
+        for i in range(3):
+            self.add_creator("collab" + str(i), mentions=["bench", "collab" + str((i + 1) % 3)], nb_posts=20, nb_files=1, file_size=1024, video_size=0,
+                             reposts=[post["file"] for post in self.creators["bench"]["posts"][i * 20:(i + 1) * 20]])
+
+    # Add a creator, the content of the files depending only on the creator, the post and the file index
+    # Arguments :
+    # - reposts : files of other creators, one added to each post (same path : same content)
+    def add_creator(self, user_id, nb_posts, nb_files, file_size, video_size, mentions=(), reposts=()):
+        posts = []
+        first_date = datetime(2024, 1, 1)
+
+        for i in range(nb_posts):
+            date = (first_date - timedelta(hours=i)).strftime('%Y-%m-%dT%H:%M:%S')
+            files = []
+
+            for j in range(nb_files):
+                size = video_size if video_size and j == 0 and i % 10 == 0 else file_size
+                extension = ".mp4" if size == video_size else ".jpg"
+                seed = hashlib.sha256((user_id + "-" + str(i) + "-" + str(j)).encode()).digest()
+
+                # Path : content hash, like the site. Only the seed is kept, the content is generated for each request
+                file_hash = hashlib.sha256(MockSite.get_content(seed, size)).hexdigest()
+                path = "/" + file_hash[0:2] + "/" + file_hash[2:4] + "/" + file_hash + extension
+
+                self.files[path] = (seed, size)
+                files.append({"name": "file" + str(i) + "_" + str(j) + extension, "path": path})
+
+            if i < len(reposts):
+                files.append({"name": "repost" + str(i) + os.path.splitext(reposts[i]["path"])[1], "path": reposts[i]["path"]})
+
+            content = "<p>Post " + str(i) + " " + " ".join("@" + mention for mention in mentions) + \
+                      ' <a href="https://example.com/' + user_id + "/" + str(i % 20) + '">link</a></p>'
+
+            posts.append({"id": str(10000000 + nb_posts - i), "user": user_id, "service": SERVICE, "title": "Post " + str(i),
+                          "content": content, "added": date, "published": date, "edited": None,
+                          "file": files[0] if files else {}, "attachments": files[1:], "embed": {}, "shared_file": False})
+
+        self.creators[user_id] = {"name": user_id + "_name", "posts": posts, "ids": {post["id"]: post for post in posts}}
+
+    # Get the content of a file
+    @staticmethod
+    def get_content(seed, size):
+        return (seed * (size // len(seed) + 1))[:size]
+
+
+# Mock server request handler : the site and the server settings are class attributes,
+# the data node settings are server attributes (data_node_urls : site redirecting to the nodes, node_index : data node)
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    site = None
+    latency = 0
+    bandwidth = 0
+    failing_node = None
+    counters = {}
+    counters_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    # Count a request by endpoint
+    def count(self, endpoint, nb_bytes=0):
+        with MockHandler.counters_lock:
+            counter = MockHandler.counters.setdefault(self.command + " " + endpoint, {"requests": 0, "bytes": 0})
+            counter["requests"] += 1
+            counter["bytes"] += nb_bytes
+
+    def send_body(self, status, body, headers=None, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if self.command == "HEAD":
+            return
+
+        # Bandwidth limit per connection
+        if MockHandler.bandwidth:
+            for i in range(0, len(body), 16384):
+                self.wfile.write(body[i:i + 16384])
+                time.sleep(min(16384, len(body) - i) / MockHandler.bandwidth)
+        else:
+            self.wfile.write(body)
+
+    def send_json(self, status, data):
+        self.send_body(status, json.dumps(data).encode())
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.count("login")
+        self.send_body(200, b"{}", {"Set-Cookie": "session=bench; Path=/"})
+
+    def do_GET(self):
+        if MockHandler.latency:
+            time.sleep(MockHandler.latency)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        site = MockHandler.site
+
+        if url.path == "/api/v1/app_version":
+            self.count("app_version")
+            return self.send_json(200, "bench")
+
+        if url.path == "/api/v1/account/favorites":
+            self.count("favorites")
+            return self.send_json(200, site.creators["bench"]["posts"][:PAGE_SIZE])
+
+        match = re.match(r'/api/v1/([^/]+)/user/([^/]+)(/profile|/post/([^/]+))?$', url.path)
+        if match:
+            creator = site.creators.get(match.group(2))
+
+            if match.group(3) == "/profile":
+                self.count("profile")
+                if creator is None:
+                    return self.send_json(404, {"error": "Creator not found."})
+                return self.send_json(200, {"id": match.group(2), "name": creator["name"], "service": match.group(1)})
+
+            if match.group(4):
+                self.count("post")
+                if creator is None or match.group(4) not in creator["ids"]:
+                    return self.send_json(404, {"error": "Post not found."})
+                return self.send_json(200, {"post": creator["ids"][match.group(4)]})
+
+            self.count("posts")
+            if creator is None:
+                return self.send_json(404, {"error": "Creator not found."})
+            offset = int(query.get("o", ["0"])[0])
+            return self.send_json(200, creator["posts"][offset:offset + PAGE_SIZE])
+
+        if url.path.startswith("/data/"):
+            # Site with data nodes : redirected to the node of the file
+            if self.server.data_node_urls:
+                self.count("data redirect")
+                node_urls = self.server.data_node_urls
+                node_url = node_urls[int(hashlib.sha256(url.path.encode()).hexdigest(), 16) % len(node_urls)]
+                return self.send_body(302, b"", {"Location": node_url + self.path})
+
+            node_index = self.server.node_index
+            if node_index is not None:
+                if node_index == MockHandler.failing_node:
+                    self.count("data n" + str(node_index) + " error")
+                    return self.send_json(502, {"error": "Bad gateway."})
+                time.sleep(node_index * NODE_LATENCY_STEP)
+
+            file = site.files.get(url.path[len("/data"):])
+            if file is None:
+                self.count("data")
+                return self.send_json(404, {"error": "File not found."})
+
+            content = MockSite.get_content(*file)
+
+            headers = {"Accept-Ranges": "bytes"}
+            status = 200
+            byte_range = re.match(r'bytes=(\d+)-(\d*)', self.headers.get("Range", ""))
+            if byte_range:
+                start = int(byte_range.group(1))
+                end = int(byte_range.group(2)) if byte_range.group(2) else len(content) - 1
+                headers["Content-Range"] = "bytes " + str(start) + "-" + str(end) + "/" + str(len(content))
+                content = content[start:end + 1]
+                status = 206
+
+            self.count("data" if node_index is None else "data n" + str(node_index), len(content) if self.command == "GET" else 0)
+            return self.send_body(status, content, headers, "application/octet-stream")
+
+        self.count("other")
+        self.send_json(404, {"error": "Not found."})
+
+
+# Start the mock server in background
+# Arguments :
+# - nb_data_nodes : number of data nodes, the site redirecting the /data requests to them (none if 0)
+# - failing_node : index of a data node answering every request with an error (none if omitted)
+#
+# Returns the server (server.server_address : (host, port), server.data_nodes : servers of the data nodes)
+def start_server(site, port=0, latency=0, bandwidth=0, nb_data_nodes=0, failing_node=None):
+    MockHandler.site = site
+    MockHandler.latency = latency
+    MockHandler.bandwidth = bandwidth
+    MockHandler.failing_node = failing_node
+
+    def serve(port, node_index=None):
+        server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+        server.daemon_threads = True
+        server.node_index = node_index
+        server.data_node_urls = None
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    data_nodes = [serve(0, i) for i in range(nb_data_nodes)]
+    server = serve(port)
+    server.data_node_urls = ["http://127.0.0.1:" + str(data_node.server_address[1]) for data_node in data_nodes]
+    server.data_nodes = data_nodes
+    return server
+
+
+# Peak resident memory of a running process in KiB (VmHWM of /proc/<pid>/status, None if not available : process ended, no /proc)
+def read_peak_memory_kb(pid):
+    try:
+        with open("/proc/" + str(pid) + "/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+# Run ckutils.py in a subprocess
+# Returns {"wall_time": seconds, "first_output_time": seconds (None if no output), "peak_memory_kb": int, "exit_code": int, "requests": int,
+#          "requests_per_endpoint": {...}, "bytes": int}
+def run_ckutils(site_url, arguments, work_dir, cache_dir):
+    with MockHandler.counters_lock:
+        MockHandler.counters.clear()
+
+    command = [sys.executable, CKUTILS, "-w", site_url, "-cd", cache_dir] + arguments
+    start_time = time.monotonic()
+
+    first_output_time = None
+
+    # Peak memory read from the process itself : ru_maxrss of a child starts from the RSS of the parent (the bench with the mock site)
+    peak_memory_kb = [None]
+    stop_watch = threading.Event()
+
+    def watch_memory():
+        while True:
+            memory_kb = read_peak_memory_kb(process.pid)
+            if memory_kb is not None:
+                peak_memory_kb[0] = max(peak_memory_kb[0] or 0, memory_kb)
+            if stop_watch.wait(0.05):
+                return
+
+    with open(os.path.join(work_dir, "output.txt"), "ab") as output:
+        # Unbuffered output : lines come when printed, not when a pipe buffer is full
+        process = subprocess.Popen(command, cwd=work_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=dict(os.environ, PYTHONUNBUFFERED="1"))
+        watcher = threading.Thread(target=watch_memory, daemon=True)
+        watcher.start()
+
+        # Output copied as it comes : time of the first line
+        for line in process.stdout:
+            if first_output_time is None:
+                first_output_time = round(time.monotonic() - start_time, 3)
+            output.write(line)
+
+        # Last read before the process is reaped
+        stop_watch.set()
+        watcher.join()
+        pid, status, usage = os.wait4(process.pid, 0)
+
+    wall_time = time.monotonic() - start_time
+
+    with MockHandler.counters_lock:
+        counters = {endpoint: dict(counter) for endpoint, counter in MockHandler.counters.items()}
+
+    return {"wall_time": round(wall_time, 3),
+            "first_output_time": first_output_time,
+            "peak_memory_kb": peak_memory_kb[0] if peak_memory_kb[0] is not None else usage.ru_maxrss,
+            "exit_code": os.waitstatus_to_exitcode(status),
+            "requests": sum(counter["requests"] for counter in counters.values()),
+            "requests_per_endpoint": {endpoint: counter["requests"] for endpoint, counter in sorted(counters.items())},
+            "bytes": sum(counter["bytes"] for counter in counters.values())}
+
+
+# Truncate half of the downloaded files into .tmp files, to benchmark the resume of interrupted downloads
+def make_partial_downloads(download_dir):
+    nb_files = 0
+
+    for directory, directories, file_names in os.walk(download_dir):
+        for file_name in sorted(file_names):
+            path = os.path.join(directory, file_name)
+            if os.path.splitext(file_name)[1] not in (".jpg", ".mp4") or nb_files % 2:
+                nb_files += 1
+                continue
+
+            size = os.path.getsize(path)
+            os.rename(path, path + ".tmp")
+            with open(path + ".tmp", "r+b") as tmp_file:
+                tmp_file.truncate(size // 2)
+            nb_files += 1
+
+
+# Run the scenarios
+# Returns {scenario: result (see run_ckutils)}
+def run_scenarios(site_url, scenarios, jobs, extra_arguments):
+    results = {}
+    base_dir = tempfile.mkdtemp(prefix="ckutils_bench_")
+
+    try:
+        cache_dir = os.path.join(base_dir, "cache")
+        download_dir = os.path.join(base_dir, "downloads")
+        os.makedirs(download_dir)
+        jobs_arguments = ["-j", str(jobs)] if jobs else []
+
+        for scenario in scenarios:
+            if scenario == "list-files":
+                arguments = ["-u", "bench", "-a", "list-files"]
+            elif scenario == "list-files-ndjson":
+                arguments = ["-u", "bench", "-a", "list-files", "-fmt", "ndjson"]
+            elif scenario == "list-files-sfs":
+                # Cold cache
+                shutil.rmtree(cache_dir, ignore_errors=True)
+                arguments = ["-u", "bench", "-a", "list-files", "-sfs"] + jobs_arguments
+            elif scenario == "list-files-sfs-cached":
+                arguments = ["-u", "bench", "-a", "list-files", "-sfs"] + jobs_arguments
+            elif scenario == "download-files":
+                shutil.rmtree(download_dir)
+                os.makedirs(download_dir)
+                arguments = ["-u", "bench", "-a", "download-files", "-q"] + jobs_arguments
+            elif scenario == "download-files-resume":
+                make_partial_downloads(download_dir)
+                # The truncated files are completed according to the download journal : check them on disk
+                arguments = ["-u", "bench", "-a", "download-files", "-q", "-rck"] + jobs_arguments
+            elif scenario == "download-files-incremental":
+                # Nothing left to download, without the journal : every file is checked on disk (-x=-di to check them in a directory index)
+                arguments = ["-u", "bench", "-a", "download-files", "-q", "-nj"] + jobs_arguments
+            elif scenario == "download-files-store":
+                # The creator and its collabs in a batch, the reposted files being linked from the content-addressed store
+                shutil.rmtree(download_dir)
+                os.makedirs(download_dir)
+                batch_file_name = os.path.join(base_dir, "batch.txt")
+                with open(batch_file_name, "w") as batch_file:
+                    batch_file.write("\n".join(["bench", "collab0", "collab1", "collab2"]) + "\n")
+                arguments = ["-b", batch_file_name, "-a", "download-files", "-q", "-cs", os.path.join(base_dir, "store")] + jobs_arguments
+            elif scenario == "list-collabs":
+                arguments = ["-u", "bench", "-a", "list-collabs"]
+            elif scenario == "list-collabs-ndjson":
+                arguments = ["-u", "bench", "-a", "list-collabs", "-fmt", "ndjson"]
+            else:
+                print("Unknown scenario '" + scenario + "'")
+                continue
+
+            result = run_ckutils(site_url, arguments + extra_arguments, download_dir, cache_dir)
+            result["throughput_bytes_per_s"] = round(result["bytes"] / result["wall_time"]) if result["wall_time"] else 0
+            results[scenario] = result
+
+            print(scenario.ljust(24) + " : " + str(result["wall_time"]).rjust(8) + " s, first output " + str(result["first_output_time"]).rjust(8) + " s, " +
+                  str(result["requests"]).rjust(6) + " requests, " +
+                  str(result["peak_memory_kb"] // 1024).rjust(5) + " MiB peak, " + str(result["throughput_bytes_per_s"] // 1024).rjust(8) + " KiB/s" +
+                  ("" if result["exit_code"] == 0 else ", exit code " + str(result["exit_code"])))
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+    return results
+
+
+# Display the differences with a previous run
+def compare_results(results, previous_results):
+    print("Comparison with " + previous_results["date"] + " :")
+
+    for scenario, result in results.items():
+        previous_result = previous_results["results"].get(scenario)
+        if previous_result is None:
+            continue
+
+        line = scenario.ljust(24) + " :"
+        for key, unit in (("wall_time", "s"), ("requests", ""), ("peak_memory_kb", "KiB")):
+            ratio = result[key] / previous_result[key] if previous_result[key] else 0
+            line += " " + key + " " + str(previous_result[key]) + unit + " -> " + str(result[key]) + unit + " (x" + str(round(ratio, 2)) + ")"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ckutils.py benchmark against a local mock site")
+    parser.add_argument("-c", "--creator-size", default="medium", choices=list(CREATOR_SIZES), help="Size of the benchmarked creator (default : medium)")
+    parser.add_argument("-s", "--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios (default : " + ",".join(SCENARIOS) + ")")
+    parser.add_argument("-l", "--latency", default=0.0, type=float, help="Latency of every response, in seconds (default : 0)")
+    parser.add_argument("-b", "--bandwidth", default=0, type=int, help="Bandwidth per connection, in bytes per second (default : no limit)")
+    parser.add_argument("-n", "--data-nodes", default=0, type=int, help="Number of data nodes the site redirects the /data requests to (default : 0, no redirect)")
+    parser.add_argument("--failing-node", default=None, type=int, help="Index of a data node answering every request with an error")
+    parser.add_argument("-j", "--jobs", default=None, type=int, help="ckutils.py --jobs for the downloads and the file sizes")
+    parser.add_argument("-x", "--extra-args", default="", help="Additional ckutils.py arguments, given with = as they start with a dash, for example -x=\"-seg 4 -st 1\"")
+    parser.add_argument("-o", "--output", default=None, help="JSON file where the results are saved")
+    parser.add_argument("--compare", default=None, help="JSON file of a previous run to compare with")
+    parser.add_argument("--serve", action='store_true', help="Only run the mock server")
+    parser.add_argument("-p", "--port", default=0, type=int, help="Port of the mock server (default : any free port)")
+    args = parser.parse_args()
+
+    site = MockSite(args.creator_size)
+    server = start_server(site, args.port, args.latency, args.bandwidth, args.data_nodes, args.failing_node)
+    site_url = "http://127.0.0.1:" + str(server.server_address[1])
+
+    if args.serve:
+        print("Mock site : " + site_url + " (users : " + ", ".join(site.creators) + ")" +
+              (", data nodes : " + ", ".join(server.data_node_urls) if server.data_node_urls else ""))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return
+
+    print("Creator '" + args.creator_size + "' : " + str(len(site.creators["bench"]["posts"])) + " posts, latency " + str(args.latency) + " s, " +
+          "bandwidth " + (str(args.bandwidth) + " B/s" if args.bandwidth else "no limit") +
+          (", " + str(args.data_nodes) + " data nodes" if args.data_nodes else ""))
+
+    results = run_scenarios(site_url, args.scenarios.split(","), args.jobs, args.extra_args.split())
+    for data_node in server.data_nodes + [server]:
+        data_node.shutdown()
+
+    run = {"date": datetime.now().isoformat(timespec='seconds'), "creator_size": args.creator_size, "latency": args.latency,
+           "bandwidth": args.bandwidth, "data_nodes": args.data_nodes, "failing_node": args.failing_node, "jobs": args.jobs, "extra_args": args.extra_args, "results": results}
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare_results(results, json.load(previous_file))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(run, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()